@@ -0,0 +1,209 @@
+'''Module with an asyncio download engine for the image chips'''
+
+import aiohttp
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.data.tools.rate_control import AdaptiveLimiter
+
+logger = logging.getLogger(__name__)
+
+
+async def _fetch(session, url, filename, chunk_size):
+    """
+    Stream a URL into a file through a pooled aiohttp session, checking the
+    transfer is not truncated. Mirrors download_gee.fetch_url.
+    """
+    part = filename + '.part'
+    try:
+        async with session.get(url) as r:
+            r.raise_for_status()
+            expected = r.content_length
+            digest = hashlib.sha256()
+            nbytes = 0
+
+            with open(part, 'wb') as out_file:
+                async for chunk in r.content.iter_chunked(chunk_size):
+                    out_file.write(chunk)
+                    digest.update(chunk)
+                    nbytes += len(chunk)
+
+        if expected is not None and nbytes != expected:
+            raise IOError(f"Truncated download for {filename}: "
+                          f"{nbytes} of {expected} bytes")
+
+        os.replace(part, filename)
+    except BaseException:
+        # do not leave a partial file behind when the transfer fails
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+
+    return nbytes, digest.hexdigest()
+
+
+def _retry_after(error):
+    """
+    Seconds requested by a 429/503 Retry-After header, if any.
+    """
+    headers = error.headers or {}
+    try:
+        return float(headers.get('Retry-After', 0))
+    except ValueError:
+        return 0
+
+
+async def _download_job(session, executor, limiter, filename, url_fn,
+                        tries, delay, backoff, chunk_size):
+    """
+    Download a single job with the same retry policy as retry_call,
+    generating a fresh URL on every attempt and reporting the outcome of
+    each attempt to the shared limiter.
+    """
+    loop = asyncio.get_running_loop()
+    wait = delay
+    started = time.time()
+    for attempt in range(tries):
+        if limiter is not None:
+            await limiter.acquire()
+
+        start = loop.time()
+        status, nbytes, error, retry_after = None, 0, None, 0
+        try:
+            # URL generation is a blocking Earth Engine call
+            url = await loop.run_in_executor(executor, url_fn)
+            nbytes, checksum = await _fetch(session, url, filename,
+                                            chunk_size)
+            status = 200
+        except aiohttp.ClientResponseError as e:
+            status, error, retry_after = e.status, e, _retry_after(e)
+        except Exception as e:
+            error = e
+
+        if limiter is not None:
+            await limiter.release(status, loop.time() - start, nbytes)
+
+        if error is None or attempt == tries - 1:
+            finished = time.time()
+            telemetry = {'started': started, 'finished': finished,
+                         'latency': finished - started, 'retries': attempt}
+
+        if error is None:
+            return {'file': os.path.basename(filename),
+                    'status': 'complete',
+                    'bytes': nbytes, 'sha256': checksum, **telemetry}
+
+        if attempt == tries - 1:
+            logger.warning('Failed to download %s: %s', filename, error)
+            return {'file': os.path.basename(filename),
+                    'status': 'failed', 'bytes': 0, 'sha256': None,
+                    'error': repr(error), **telemetry}
+
+        await asyncio.sleep(max(wait, retry_after))
+        wait *= backoff
+
+
+async def _report(limiter, every):
+    while True:
+        await asyncio.sleep(every)
+        stats = limiter.stats()
+        logger.info('limit %d, in flight %d, %d chips, %.1f chips/s, '
+                    '%.2f MB/s, %d throttled or failed requests',
+                    stats['limit'], stats['in_flight'], stats['completed'],
+                    stats['requests_per_s'], stats['bytes_per_s'] / 1e6,
+                    stats['congested'])
+
+
+async def _run(jobs, concurrency, url_workers, tries, delay, backoff,
+               chunk_size, on_record, limiter, report_every):
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=0,
+                                     keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=300)
+
+    with ThreadPoolExecutor(max_workers=url_workers) as executor:
+        async with aiohttp.ClientSession(connector=connector,
+                                         timeout=timeout) as session:
+
+            async def worker():
+                while True:
+                    job = await queue.get()
+                    if job is None:
+                        queue.task_done()
+                        return
+                    filename, url_fn = job
+                    record = await _download_job(session, executor,
+                                                 limiter, filename, url_fn,
+                                                 tries, delay, backoff,
+                                                 chunk_size)
+                    on_record(record)
+                    queue.task_done()
+
+            workers = [asyncio.create_task(worker())
+                       for _ in range(concurrency)]
+            reporter = None
+            if limiter is not None and report_every:
+                reporter = asyncio.create_task(_report(limiter,
+                                                       report_every))
+
+            # Feed the queue lazily so memory does not grow with the jobs.
+            # The jobs may come from a generator that blocks on Earth
+            # Engine calls, so it is advanced in its own thread.
+            loop = asyncio.get_running_loop()
+            jobs = iter(jobs)
+            with ThreadPoolExecutor(max_workers=1) as feeder:
+                while True:
+                    job = await loop.run_in_executor(feeder, next, jobs,
+                                                     None)
+                    if job is None:
+                        break
+                    await queue.put(job)
+            for _ in workers:
+                await queue.put(None)
+
+            await asyncio.gather(*workers)
+            if reporter is not None:
+                reporter.cancel()
+
+
+def download_async(jobs, on_record, concurrency=256, url_workers=32,
+                   tries=10, delay=1, backoff=2, chunk_size=1 << 20,
+                   adaptive=True, target_latency=None, report_every=30):
+    """
+    Download chips from a single process using asyncio and a pool of
+    keep-alive HTTP connections.
+
+    Parameters:
+    - jobs (iterable): (filename, url_fn) pairs, where url_fn is a callable returning the URL to download.
+    - on_record (callable): Called with the manifest record of every finished chip.
+    - concurrency (int): Maximum number of in-flight requests. Default: 256.
+    - url_workers (int): Threads used to generate the URLs. Default: 32.
+    - tries (int): Attempts per chip before giving up. Default: 10.
+    - delay (float): Seconds to wait before the first retry. Default: 1.
+    - backoff (float): Multiplier applied to the delay after each retry. Default: 2.
+    - chunk_size (int): Number of bytes written at a time. Default: 1 MiB.
+    - adaptive (bool): Grow and shrink the number of in-flight requests with an AIMD controller driven by the 429/5xx rate and latency, up to concurrency. Default: True.
+    - target_latency (float): Latency in seconds above which the controller backs off. Default: None.
+    - report_every (float): Seconds between throughput log lines, 0 disables them. Default: 30.
+
+    Returns:
+    - stats (dict): Final limit and effective throughput of the controller, None when adaptive is False.
+
+    Example Usage:
+    download_async([('tile_1_s1.tif', lambda: 'http://host/chip/1')], print, concurrency=64)
+    """ # noqa
+    async def main():
+        # The limiter must be created inside the running event loop
+        limiter = None
+        if adaptive:
+            limiter = AdaptiveLimiter(initial=min(16, concurrency),
+                                      maximum=concurrency,
+                                      target_latency=target_latency)
+        await _run(jobs, concurrency, url_workers, tries, delay, backoff,
+                   chunk_size, on_record, limiter, report_every)
+        return limiter.stats() if limiter is not None else None
+
+    return asyncio.run(main())
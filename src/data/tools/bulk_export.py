@@ -0,0 +1,100 @@
+'''
+Module to group sampling points into export regions and
+cut the image chips locally from the downloaded regions
+'''
+import math
+import os
+import rasterio
+from rasterio.windows import from_bounds
+from src.data.tools.chip_naming import chip_filename
+from src.data.tools.download_manifest import file_checksum
+
+
+def group_chips(chips, res: int, region_pixels=2048):
+    """
+    Group chips into export regions of at most region_pixels x region_pixels.
+
+    The chips are assigned to the cells of a regular grid by their centre
+    and each region is the union of the bounds of the chips in a cell.
+
+    Parameters:
+    - chips (list): (index, bounds) pairs of the chips to download.
+    - res (int): The pixel resolution in meters.
+    - region_pixels (int): Maximum side of a region in pixels. Default: 2048.
+
+    Returns:
+    - regions (list): (bounds, chips) pairs, one per export region.
+
+    Example Usage:
+    group_chips([(0, plan_chip(-47.1, -22.9))], 5, region_pixels=2048)
+    """ # noqa
+    if len(chips) == 0:
+        return []
+
+    max_width = max(max(b[2] - b[0], b[3] - b[1]) for _, b in chips)
+    cell_size = region_pixels * res - max_width
+
+    cells = {}
+    for index, bounds in chips:
+        if cell_size <= 0:
+            # Chips too large to share a region are exported one by one
+            key = index
+        else:
+            key = (math.floor((bounds[0] + bounds[2]) / 2 / cell_size),
+                   math.floor((bounds[1] + bounds[3]) / 2 / cell_size))
+        cells.setdefault(key, []).append((index, bounds))
+
+    regions = []
+    for members in cells.values():
+        bounds = (min(b[0] for _, b in members),
+                  min(b[1] for _, b in members),
+                  max(b[2] for _, b in members),
+                  max(b[3] for _, b in members))
+        regions.append((bounds, members))
+
+    return regions
+
+
+def cut_chips(region_file: str, chips, out_dir: str, size: int,
+              sulfix: str):
+    """
+    Cut the chips of an export region with windowed reads and delete the
+    region raster afterwards.
+
+    Parameters:
+    - region_file (str): The file path of the downloaded region.
+    - chips (list): (index, bounds) pairs of the chips inside the region.
+    - out_dir (str): The directory to save the chips.
+    - size (int): The total number of points.
+    - sulfix (str): The suffix to add to the chip filenames.
+
+    Returns:
+    - records (list): The manifest records of the chips.
+    """
+    records = []
+    with rasterio.open(region_file) as src:
+        for index, bounds in chips:
+            window = from_bounds(*bounds, transform=src.transform)
+            window = window.round_offsets().round_lengths()
+
+            data = src.read(window=window)
+
+            profile = src.profile.copy()
+            profile.update({
+                'height': window.height,
+                'width': window.width,
+                'transform': src.window_transform(window)
+            })
+
+            filename = chip_filename(index, out_dir, size, sulfix)
+            with rasterio.open(filename, 'w', **profile) as dst:
+                dst.write(data)
+
+            records.append({'file': os.path.basename(filename),
+                            'status': 'complete',
+                            'bytes': os.path.getsize(filename),
+                            'sha256': file_checksum(filename)})
+
+    os.remove(region_file)
+
+    return records
@@ -0,0 +1,310 @@
+'''Module with a persistent catalog of the image chips keyed by tile ID'''
+
+import contextlib
+import glob
+import os
+import re
+import rasterio
+import sqlite3
+import warnings
+
+# Chips follow the tile_<index>_<sensor>.tif naming convention, or .vrt
+# for the virtual crops
+TILE_PATTERN = re.compile(r'^(tile_\d+)_(.+)\.(?:tif|vrt)$')
+
+
+def parse_tile(filename: str):
+    """
+    Split a chip filename into its tile ID and sensor.
+
+    Parameters:
+    - filename (str): The file path of the chip.
+
+    Returns:
+    - (tile, sensor): e.g. ('tile_0001', 'planet'), or None if the file does
+    not follow the naming convention.
+    """
+    match = TILE_PATTERN.match(os.path.basename(filename))
+    if match is None:
+        return None
+    return match.group(1), match.group(2)
+
+
+def tile_ids(paths):
+    """
+    Return the tile IDs of a list of chips, e.g. to index a packed store.
+    """
+    return [parse_tile(path)[0] for path in paths]
+
+
+def newest_per_tile(entries):
+    """
+    Keep one chip per tile when a GeoTIFF and a virtual crop of the same
+    tile coexist, e.g. a .vrt left over from an earlier virtual crop. The
+    most recently written file wins, the GeoTIFF on ties, and the others
+    are reported with a warning.
+
+    Parameters:
+    - entries (iterable): (tile, path, mtime) of the chips of one sensor.
+
+    Returns:
+    - files (list): The file paths of the chips ordered by tile ID.
+    """
+    chosen = {}
+    for tile, path, mtime in entries:
+        key = (mtime, path.endswith('.tif'))
+        if tile in chosen:
+            stale = min((chosen[tile], (key, path)))[1]
+            warnings.warn(f"{tile} has several chips, ignoring {stale}")
+            if key < chosen[tile][0]:
+                continue
+        chosen[tile] = (key, path)
+    return [path for _, (_, path) in sorted(chosen.items())]
+
+
+class TileCatalog:
+    """
+    SQLite index of the chips of one or more directories, keyed by tile ID
+    and sensor. Every raster stores its path, bounds, CRS, shape, dtype,
+    size and mtime, and every tile its split. Updates are incremental:
+    only new or modified files have their header read.
+
+    Parameters:
+    - path (str): The file path of the catalog.
+
+    Example Usage:
+    with TileCatalog('data/tile_catalog.sqlite') as catalog:
+        catalog.update('data/croped_data')
+        files = catalog.files('data/croped_data', 'planet')
+    """
+    def __init__(self, path: str):
+        self.con = sqlite3.connect(path)
+        self.con.execute('CREATE TABLE IF NOT EXISTS rasters '
+                         '(path TEXT PRIMARY KEY, directory TEXT, '
+                         'tile TEXT, sensor TEXT, minx REAL, miny REAL, '
+                         'maxx REAL, maxy REAL, crs TEXT, width INTEGER, '
+                         'height INTEGER, count INTEGER, dtype TEXT, '
+                         'size INTEGER, mtime INTEGER)')
+        self.con.execute('CREATE INDEX IF NOT EXISTS rasters_tile '
+                         'ON rasters (directory, sensor, tile)')
+        self.con.execute('CREATE TABLE IF NOT EXISTS splits '
+                         '(tile TEXT PRIMARY KEY, split TEXT)')
+
+    def update(self, directory: str):
+        """
+        Index the chips of a directory, reading the header of the new or
+        modified files only and dropping the deleted ones.
+
+        Returns:
+        - changed (int): The number of rasters (re)indexed.
+        """
+        directory = os.path.abspath(directory)
+        known = {path: (size, mtime) for path, size, mtime in
+                 self.con.execute('SELECT path, size, mtime FROM rasters '
+                                  'WHERE directory = ?', (directory,))}
+
+        rows = []
+        seen = set()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                parsed = parse_tile(entry.name)
+                if parsed is None or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                seen.add(entry.path)
+                if known.get(entry.path) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                with rasterio.open(entry.path) as src:
+                    rows.append((entry.path, directory, *parsed,
+                                 *src.bounds,
+                                 src.crs.to_string() if src.crs else None,
+                                 src.width, src.height, src.count,
+                                 src.dtypes[0], stat.st_size,
+                                 stat.st_mtime_ns))
+
+        self.con.executemany('INSERT OR REPLACE INTO rasters VALUES '
+                             '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             rows)
+        self.con.executemany('DELETE FROM rasters WHERE path = ?',
+                             [(path,) for path in known if path not in seen])
+        self.con.commit()
+        return len(rows)
+
+    def files(self, directory: str, sensor: str, split=None):
+        """
+        Return the paths of the chips of a sensor ordered by tile ID,
+        optionally only the tiles of a split, one per tile.
+        """
+        query = ('SELECT r.tile, r.path, r.mtime FROM rasters r '
+                 'LEFT JOIN splits s '
+                 'ON r.tile = s.tile WHERE r.directory = ? '
+                 'AND r.sensor = ?')
+        params = [os.path.abspath(directory), sensor]
+        if split is not None:
+            query += ' AND s.split = ?'
+            params.append(split)
+        return newest_per_tile(self.con.execute(query, params))
+
+    def tiles(self, sources: dict, split=None, complete=True):
+        """
+        Pair the chips of several sensors by tile ID.
+
+        Parameters:
+        - sources (dict): {sensor: directory} of the chips to pair.
+        - split (str): Only return the tiles of this split. Default: None.
+        - complete (bool): Only return the tiles with every sensor. Default: True.
+
+        Returns:
+        - tiles (dict): {tile: {sensor: path}} ordered by tile ID.
+        """ # noqa
+        paired = {}
+        for sensor, directory in sources.items():
+            for path in self.files(directory, sensor, split):
+                tile, _ = parse_tile(path)
+                paired.setdefault(tile, {})[sensor] = path
+        return {tile: paths for tile, paths in sorted(paired.items())
+                if not complete or len(paths) == len(sources)}
+
+    def record(self, path: str):
+        """
+        Return the indexed metadata of a raster as a dict, or None.
+        """
+        cursor = self.con.execute('SELECT * FROM rasters WHERE path = ?',
+                                  (os.path.abspath(path),))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([c[0] for c in cursor.description], row))
+
+    def bounds(self, path: str):
+        """
+        Return the indexed (minx, miny, maxx, maxy) of a raster.
+        """
+        record = self.record(path)
+        return (record['minx'], record['miny'],
+                record['maxx'], record['maxy'])
+
+    def set_split(self, tiles, split: str):
+        self.con.executemany('INSERT OR REPLACE INTO splits VALUES (?, ?)',
+                             [(tile, split) for tile in tiles])
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@contextlib.contextmanager
+def open_catalog(catalog, *directories):
+    """
+    Open a catalog once per tool entry point and bring the index of the
+    directories up to date, so the functions below only query it. A catalog
+    opened from a file path is closed on exit, a TileCatalog passed in is
+    left open for its owner.
+
+    Parameters:
+    - catalog (str or TileCatalog): The catalog or the file path of it, or None.
+    - directories (str): The directories to index.
+
+    Returns:
+    - catalog (TileCatalog): The updated catalog, or None without catalog.
+
+    Example Usage:
+    with open_catalog('data/tile_catalog.sqlite', 'data/croped_data') as catalog:
+        files = list_files('data/croped_data', 'ndvi', catalog)
+    """ # noqa
+    if catalog is None:
+        yield None
+        return
+
+    owned = not isinstance(catalog, TileCatalog)
+    if owned:
+        catalog = TileCatalog(catalog)
+    try:
+        for directory in dict.fromkeys(map(os.path.abspath, directories)):
+            catalog.update(directory)
+        yield catalog
+    finally:
+        if owned:
+            catalog.close()
+
+
+def list_files(directory: str, sensor: str, catalog=None):
+    """
+    List the chips of a sensor in a directory ordered by tile ID, GeoTIFFs
+    and virtual crops alike, one per tile (see newest_per_tile). Without a
+    catalog the directory is scanned with glob.
+
+    Parameters:
+    - directory (str): The directory of the chips.
+    - sensor (str): The sensor suffix of the chips, e.g. 'planet' or 'ref'.
+    - catalog (TileCatalog): The tile catalog to query, indexed by open_catalog. Default: None.
+
+    Returns:
+    - files (list): The file paths of the chips.
+
+    Example Usage:
+    list_files('data/croped_data', 'ndvi', catalog)
+    """ # noqa
+    if catalog is None:
+        pattern = os.path.join(directory, '*' + sensor)
+        paths = glob.glob(pattern + '.tif') + glob.glob(pattern + '.vrt')
+        # files outside the naming convention are kept under their path
+        return newest_per_tile(((parse_tile(path) or (path,))[0], path,
+                                os.stat(path).st_mtime_ns)
+                               for path in paths)
+    return catalog.files(directory, sensor)
+
+
+def tile_index(sources: dict, catalog=None, complete=True):
+    """
+    Pair the chips of several sensors by tile ID. Without a catalog the
+    directories are scanned with glob.
+
+    Parameters:
+    - sources (dict): {sensor: directory} of the chips to pair.
+    - catalog (TileCatalog): The tile catalog to query, indexed by open_catalog. Default: None.
+    - complete (bool): Only return the tiles with every sensor. Default: True.
+
+    Returns:
+    - tiles (dict): {tile: {sensor: path}} ordered by tile ID.
+
+    Example Usage:
+    tile_index({'planet': 'data/croped_data', 'ref': 'data/croped_data'})
+    """ # noqa
+    if catalog is not None:
+        return catalog.tiles(sources, complete=complete)
+
+    paired = {}
+    for sensor, directory in sources.items():
+        for path in list_files(directory, sensor):
+            parsed = parse_tile(path)
+            if parsed is not None and parsed[1] == sensor:
+                paired.setdefault(parsed[0], {})[sensor] = path
+    return {tile: paths for tile, paths in sorted(paired.items())
+            if not complete or len(paths) == len(sources)}
+
+
+def pair_files(sources: dict, catalog=None):
+    """
+    List the chips of several sensors, aligned by tile ID. Tiles missing a
+    sensor are left out.
+
+    Parameters:
+    - sources (dict): {sensor: directory} of the chips to pair.
+    - catalog (TileCatalog): The tile catalog to query, indexed by open_catalog. Default: None.
+
+    Returns:
+    - files (dict): {sensor: file paths}, one list per sensor.
+
+    Example Usage:
+    pair_files({'planet': 'data/train_images', 'ref': 'data/train_masks'})
+    """ # noqa
+    tiles = tile_index(sources, catalog).values()
+    return {sensor: [paths[sensor] for paths in tiles]
+            for sensor in sources}
@@ -0,0 +1,31 @@
+'''Module with the naming convention shared by the image chips'''
+
+import os
+
+# Column of the sampling points holding the stable ID that names their chips
+POINT_ID = 'point_id'
+
+
+def chip_filename(index: int, out_dir: str, size: int, sulfix: str,
+                  ext='tif'):
+    """
+    Build the file path of an image chip following the
+    tile_<index><sulfix>.<ext> convention.
+
+    Parameters:
+    - index (int): The ID of the sampling point, see POINT_ID.
+    - out_dir (str): The directory where the chip is saved.
+    - size (int): The total number of points, used to zero-pad the index.
+    - sulfix (str): The suffix added to the chip filename.
+    - ext (str): The file extension. Default: 'tif'.
+
+    Returns:
+    - filename (str): Absolute path of the chip.
+
+    Example Usage:
+    chip_filename(7, 'data/gee_data', 1500, '_planet')
+    """
+    folder = os.path.abspath(out_dir)
+    prefix = 'tile_'
+    basename = str(index).zfill(len(str(size)))
+    return f"{folder}/{prefix}{basename}{sulfix}.{ext}"
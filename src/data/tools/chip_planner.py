@@ -0,0 +1,86 @@
+'''Module to plan the geometry of the image chips around sampling points'''
+
+import math
+
+# Radius of the sphere used by EPSG:3857
+EARTH_RADIUS = 6378137
+
+# Final chip side in meters: 400 px of Planet (5m), 200 px of
+# Sentinel-1 (10m) and 100 px of ALOS/PALSAR-2 (20m)
+CHIP_SIZE = 2000
+
+# Grid the chips are snapped to, the coarsest sensor resolution, so the
+# bounds are pixel-aligned for every sensor
+CHIP_ALIGN = 20
+
+
+def lonlat_to_mercator(lon: float, lat: float):
+    """
+    Project geographic coordinates into EPSG:3857.
+
+    Parameters:
+    - lon (float): Longitude in degrees.
+    - lat (float): Latitude in degrees.
+
+    Returns:
+    - (x, y): The projected coordinates in meters.
+    """
+    x = EARTH_RADIUS * math.radians(lon)
+    y = EARTH_RADIUS * math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+    return x, y
+
+
+def buffer_bounds(lon: float, lat: float, res: int, buffer=2000):
+    """
+    Compute the EPSG:3857 bounds of the legacy chip downloaded around a
+    point, i.e. the pixels of the res grid covered by
+    point.buffer(buffer).bounds().
+
+    Parameters:
+    - lon (float): Longitude of the point in degrees.
+    - lat (float): Latitude of the point in degrees.
+    - res (int): The pixel resolution in meters.
+    - buffer (int): The buffer around the point in meters. Default: 2000.
+
+    Returns:
+    - (minx, miny, maxx, maxy): The pixel-aligned bounds.
+    """
+    x, y = lonlat_to_mercator(lon, lat)
+    # Ground distances are stretched by 1 / cos(lat) in EPSG:3857
+    half = buffer / math.cos(math.radians(lat))
+    return (math.floor((x - half) / res) * res,
+            math.floor((y - half) / res) * res,
+            math.ceil((x + half) / res) * res,
+            math.ceil((y + half) / res) * res)
+
+
+def plan_chip(lon: float, lat: float, chip_size=CHIP_SIZE,
+              align=CHIP_ALIGN):
+    """
+    Compute the exact EPSG:3857 bounds of the final chip around a point.
+
+    The bounds are chip_size wide and snapped to a grid of align meters,
+    so they are pixel-aligned and hold exactly chip_size / res pixels for
+    every resolution res dividing align, and every sensor of a tile
+    shares the same extent.
+
+    Parameters:
+    - lon (float): Longitude of the point in degrees.
+    - lat (float): Latitude of the point in degrees.
+    - chip_size (int): The side of the chip in meters. Default: 2000.
+    - align (int): The grid the bounds are snapped to in meters. Default: 20.
+
+    Returns:
+    - (minx, miny, maxx, maxy): The chip bounds.
+
+    Example Usage:
+    plan_chip(-47.1, -22.9)  # 400x400 px at 5m, 200x200 at 10m, 100x100 at 20m
+    """ # noqa
+    if chip_size % align != 0:
+        raise ValueError(f"chip_size {chip_size} is not a multiple of "
+                         f"align {align}")
+
+    x, y = lonlat_to_mercator(lon, lat)
+    minx = round((x - chip_size / 2) / align) * align
+    miny = round((y - chip_size / 2) / align) * align
+    return (minx, miny, minx + chip_size, miny + chip_size)
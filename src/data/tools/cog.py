@@ -0,0 +1,64 @@
+'''Module to rewrite image chips as Cloud-Optimized GeoTIFFs'''
+
+import os
+import rasterio
+import rasterio.shutil
+import time
+from src.data.tools.download_manifest import file_checksum
+
+
+def to_cog(filename: str, compress='DEFLATE', blocksize=256,
+           resampling='nearest'):
+    """
+    Rewrite a GeoTIFF in place as a tiled, compressed Cloud-Optimized
+    GeoTIFF with internal overviews.
+
+    Parameters:
+    - filename (str): The file path of the GeoTIFF.
+    - compress (str): The compression codec, e.g. 'DEFLATE', 'ZSTD' or 'LZW'. Default: 'DEFLATE'.
+    - blocksize (int): The side of the internal tiles in pixels. Default: 256.
+    - resampling (str): The resampling used to build the overviews. Default: 'nearest', safe for masks.
+
+    Returns:
+    - nbytes (int): The size of the rewritten file.
+    - checksum (str): The SHA-256 checksum of the rewritten file.
+
+    Example Usage:
+    to_cog('data/gee_data/tile_0001_planet.tif', compress='ZSTD')
+    """ # noqa
+    tmp = filename + '.cog'
+    with rasterio.open(filename) as src:
+        rasterio.shutil.copy(src, tmp, driver='COG', compress=compress,
+                             predictor='YES', blocksize=blocksize,
+                             overview_resampling=resampling)
+    os.replace(tmp, filename)
+
+    return os.path.getsize(filename), file_checksum(filename)
+
+
+def cog_record(record: dict, out_dir: str, **kwargs):
+    """
+    Convert a downloaded chip to COG and return its updated manifest
+    record. If the conversion fails, the original download is kept.
+
+    Parameters:
+    - record (dict): The manifest record of the downloaded chip.
+    - out_dir (str): The directory holding the chip.
+    - **kwargs: Options passed to to_cog.
+
+    Returns:
+    - record (dict): The record with the size and checksum of the COG.
+    """
+    filename = os.path.join(os.path.abspath(out_dir), record['file'])
+    record = dict(record)
+    started = time.time()
+    try:
+        record['bytes'], record['sha256'] = to_cog(filename, **kwargs)
+        record['cog'] = True
+    except Exception as e:
+        if os.path.exists(filename + '.cog'):
+            os.remove(filename + '.cog')
+        record['cog'] = False
+        record['cog_error'] = repr(e)
+    record['cog_seconds'] = time.time() - started
+    return record
@@ -0,0 +1,69 @@
+'''Module to store normalized chips as float16 or uint8 and expand them on read'''
+
+import torch
+
+# Storage modes of the normalized chips. Masks are kept as uint8 in every
+# mode other than float32, where they are float32.
+STORAGES = ('float32', 'float16', 'uint8')
+
+
+def check_storage(storage: str):
+    if storage not in STORAGES:
+        raise ValueError(f"storage must be one of {STORAGES}, "
+                         f"got {storage!r}")
+
+
+def compact(tensor, storage='float32', value_range=(0, 1)):
+    """
+    Convert a normalized float32 chip to its storage dtype.
+
+    Parameters:
+    - tensor (torch.Tensor): The normalized chip.
+    - storage (str): 'float32' (unchanged), 'float16' or 'uint8'. Default: 'float32'.
+    - value_range (tuple): The (low, high) range of the normalized values, quantized linearly to 0-255 with uint8. Values outside are clipped. Default: (0, 1).
+
+    Returns:
+    - tensor (torch.Tensor): The chip in its storage dtype.
+
+    Example Usage:
+    compact(img_tensor, 'uint8', (0, 1))
+    """ # noqa
+    check_storage(storage)
+    if storage == 'float16':
+        return tensor.half()
+    if storage == 'uint8':
+        low, high = value_range
+        scaled = torch.round((tensor - low) * (255 / (high - low)))
+        return scaled.clamp_(0, 255).to(torch.uint8)
+    return tensor
+
+
+def compact_mask(mask, storage='float32'):
+    """
+    Convert a binary mask to float32 with the float32 storage, to uint8
+    otherwise.
+    """
+    check_storage(storage)
+    if storage == 'float32':
+        return mask.float()
+    return mask.to(torch.uint8)
+
+
+def expand(tensor, value_range=(0, 1)):
+    """
+    Return a chip stored by compact as float32, dequantizing uint8 with the
+    value_range it was quantized with. float32 chips are returned as is.
+    """
+    if tensor.dtype == torch.uint8:
+        low, high = value_range
+        return tensor.float() * ((high - low) / 255) + low
+    return tensor.float()
+
+
+def expand_mask(mask):
+    """
+    Return a uint8 mask as float32, other masks as is.
+    """
+    if mask.dtype == torch.uint8:
+        return mask.float()
+    return mask
@@ -3,12 +3,121 @@ Module to crop image chips in order to achieve
 consistent spatial extent and pixel resolution
 '''
 import glob
+import multiprocessing
 import rasterio
+import shutil
+import warnings
 from rasterio.windows import Window
 from rasterio.windows import from_bounds
+from tqdm import tqdm
+from src.data.tools.catalog import list_files, open_catalog, parse_tile
+from src.data.tools.virtual_raster import vrt_filename, write_window_vrt
 
 
-def crop_ref_img(path: str, out_dir: str):
+def _crop_ref_file(file: str, out_dir: str, virtual=False):
+    """
+    Crop one reference raster to its central 400x400 pixels and return the
+    bounds of the cropped raster.
+    """
+    save_string = out_dir + '/' + file.split('/')[-1]
+
+    with rasterio.open(file) as src:
+        # Get the image dimensions
+        width = src.width
+        height = src.height
+
+        # Chips downloaded with the exact extent are already 400x400
+        if width == 400 and height == 400:
+            if virtual:
+                return write_window_vrt(file, Window(0, 0, width, height),
+                                        vrt_filename(save_string))
+            shutil.copy(file, save_string)
+            return tuple(src.bounds)
+
+        # Calculate the central coordinates
+        center_x = width // 2
+        center_y = height // 2
+
+        # Calculate the window coordinates
+        half_width = 200  # Half of the desired window width
+        left = center_x - half_width
+        top = center_y - half_width
+        right = center_x + half_width
+        bottom = center_y + half_width
+
+        # Create the window
+        window = Window.from_slices((top, bottom), (left, right))
+
+        # Reference the window instead of copying it
+        if virtual:
+            return write_window_vrt(file, window, vrt_filename(save_string))
+
+        # Read the windowed data
+        windowed_data = src.read(window=window)
+
+        # Update the metadata for the windowed data
+        window_transform = rasterio.windows.transform(window,
+                                                      src.transform)
+        window_profile = src.profile.copy()
+        window_profile.update({
+            'height': window.height,
+            'width': window.width,
+            'transform': window_transform
+        })
+
+    # Write the windowed data to a new raster file
+    with rasterio.open(save_string, 'w', **window_profile) as dst:
+        dst.write(windowed_data)
+        return tuple(dst.bounds)
+
+
+def _crop_to_bounds(to_crop_file: str, bounds, out_dir: str, virtual=False):
+    """
+    Crop one raster to the bounds of its reference raster.
+    """
+    xmin, ymin, xmax, ymax = bounds
+    save_string = out_dir + '/' + to_crop_file.split('/')[-1]
+
+    with rasterio.open(to_crop_file) as data:
+        # Chips downloaded with the exact extent already match the
+        # reference
+        if tuple(data.bounds) == (xmin, ymin, xmax, ymax):
+            if virtual:
+                write_window_vrt(to_crop_file,
+                                 Window(0, 0, data.width, data.height),
+                                 vrt_filename(save_string))
+                return
+            shutil.copy(to_crop_file, save_string)
+            return
+
+        # Create a window from the bounding box coordinates
+        window = from_bounds(xmin, ymin, xmax, ymax,
+                             transform=data.transform)
+
+        # Reference the window instead of copying it
+        if virtual:
+            write_window_vrt(to_crop_file, window, vrt_filename(save_string))
+            return
+
+        # Read the cropped raster data within the window
+        cropped_data = data.read(window=window)
+
+        # Create a new transform for the cropped raster
+        cropped_transform = data.window_transform(window)
+
+        # Create a new profile for the cropped raster
+        cropped_profile = data.profile
+        cropped_profile.update({
+            'height': window.height,
+            'width': window.width,
+            'transform': cropped_transform
+        })
+        # Write the cropped raster to a new file
+        with rasterio.open(save_string, 'w', **cropped_profile) as dst:
+            dst.write(cropped_data)
+
+
+def crop_ref_img(path: str, out_dir: str, catalog=None, virtual=False):
     """
     Crop the reference raster to a size of 400x400 pixels by
     utilizing the central pixel as a reference point.
@@ -20,58 +129,28 @@ def crop_ref_img(path: str, out_dir: str):
 
     - out_dir (str): The output directory where the cropped raster will be saved.
 
+    - catalog (str): The tile catalog used to list the rasters instead of scanning the directory. Default: None.
+
+    - virtual (bool): Write .vrt files referencing the window of the original raster instead of copying the pixels. Default: False.
+
     Example Usage:
     crop_ref_img(path='path/to/reference/raster.tif', out_dir='output/directory')
     """ # noqa
 
     # Open the raster image file
-    files = sorted(glob.glob(path + '/*ref.tif'))
-    
-    if len(files) == 0:
-        files = sorted(glob.glob(path + '/*planet.tif'))
-
-    for file in files:
-        with rasterio.open(file) as src:
-            # Get the image dimensions
-            width = src.width
-            height = src.height
-
-            # Calculate the central coordinates
-            center_x = width // 2
-            center_y = height // 2
-
-            # Calculate the window coordinates
-            half_width = 200  # Half of the desired window width
-            left = center_x - half_width
-            top = center_y - half_width
-            right = center_x + half_width
-            bottom = center_y + half_width
+    with open_catalog(catalog, path) as catalog:
+        files = list_files(path, 'ref', catalog)
 
-            # Create the window
-            window = Window.from_slices((top, bottom), (left, right))
+        if len(files) == 0:
+            files = list_files(path, 'planet', catalog)
 
-            # Read the windowed data
-            windowed_data = src.read(window=window)
-
-            # Update the metadata for the windowed data
-            window_transform = rasterio.windows.transform(window,
-                                                          src.transform)
-            window_profile = src.profile.copy()
-            window_profile.update({
-                'height': window.height,
-                'width': window.width,
-                'transform': window_transform
-            })
-
-        # Write the windowed data to a new raster file
-
-        save_string = out_dir + '/' + file.split('/')[-1]
-        with rasterio.open(save_string, 'w', **window_profile) as dst:
-            dst.write(windowed_data)
+    for file in files:
+        _crop_ref_file(file, out_dir, virtual)
 
 
 def crop_other_img(sensor: str, to_crop_path: str,
-                   out_dir: str, ref_path: str):
+                   out_dir: str, ref_path: str, catalog=None,
+                   virtual=False):
     """
     Crop other rasters to match the spatial extent of the reference raster for the given sensor.
     The resulting cropped rasters are saved in the specified output directory.
@@ -81,6 +160,8 @@ def crop_other_img(sensor: str, to_crop_path: str,
     - to_crop_path (str): The path to the rasters to be cropped.
     - out_dir (str): The output directory where the cropped rasters will be saved.
     - ref_path (str): The path to the reference rasters.
+    - catalog (str): The tile catalog used to pair the rasters by tile ID and read the reference bounds. Default: None, pair the sorted files by position.
+    - virtual (bool): Write .vrt files referencing the window of the original raster instead of copying the pixels. Default: False.
 
     Example Usage:
     crop_other_img(sensor='planet', to_crop_path='path/to/rasters',
@@ -88,36 +169,98 @@ def crop_other_img(sensor: str, to_crop_path: str,
                    ref_path='path/to/reference/rasters')
     """ # noqa
 
-    ref_files = sorted(glob.glob(ref_path + '/*ref.tif'))
-    
+    if catalog is not None:
+        with open_catalog(catalog, ref_path, to_crop_path) as catalog:
+            ref_sensor = 'ref' if catalog.files(ref_path, 'ref') else 'planet'
+            sources = {ref_sensor: ref_path, sensor: to_crop_path}
+            tiles = [(paths[sensor], catalog.bounds(paths[ref_sensor]))
+                     for paths in catalog.tiles(sources).values()]
+        for to_crop_file, bounds in tiles:
+            _crop_to_bounds(to_crop_file, bounds, out_dir, virtual)
+        return
+
+    ref_files = list_files(ref_path, 'ref')
+
     if len(ref_files) == 0:
-        ref_files = sorted(glob.glob(ref_path + '/*planet.tif'))
+        ref_files = list_files(ref_path, 'planet')
 
     to_crop_files = sorted(glob.glob(to_crop_path + '/*' + sensor + '.tif'))
 
     for ref_file, to_crop_file in zip(ref_files, to_crop_files):
         with rasterio.open(ref_file) as src:
-            xmin, ymin, xmax, ymax = src.bounds
-
-        with rasterio.open(to_crop_file) as data:
-            # Create a window from the bounding box coordinates
-            window = from_bounds(xmin, ymin, xmax, ymax,
-                                 transform=data.transform)
-
-            # Read the cropped raster data within the window
-            cropped_data = data.read(window=window)
-
-            # Create a new transform for the cropped raster
-            cropped_transform = data.window_transform(window)
-
-            # Create a new profile for the cropped raster
-            cropped_profile = data.profile
-            cropped_profile.update({
-                'height': window.height,
-                'width': window.width,
-                'transform': cropped_transform
-            })
-            save_string = out_dir + '/' + to_crop_file.split('/')[-1]
-            # Write the cropped raster to a new file
-            with rasterio.open(save_string, 'w', **cropped_profile) as dst:
-                dst.write(cropped_data)
+            bounds = tuple(src.bounds)
+
+        _crop_to_bounds(to_crop_file, bounds, out_dir, virtual)
+
+
+def _crop_tile(args):
+    """
+    Crop the reference raster of a tile and every other sensor to its
+    bounds, reading the reference once.
+    """
+    ref_file, to_crop_files, out_dir, virtual = args
+    bounds = _crop_ref_file(ref_file, out_dir, virtual)
+    for to_crop_file in to_crop_files:
+        _crop_to_bounds(to_crop_file, bounds, out_dir, virtual)
+    return ref_file
+
+
+def crop_tiles(path: str, out_dir: str, sensors=('ndvi', 's1', 'palsar'),
+               num_workers=None, catalog=None, virtual=False):
+    """
+    Crop the reference raster and the rasters of every sensor of each tile in
+    one task, with the tiles spread across a process pool. The outputs are
+    the same as crop_ref_img followed by crop_other_img for every sensor,
+    but the reference bounds are only read once per tile and the sensors
+    are paired with the reference by tile ID.
+
+    Parameters:
+    - path (str): The path to the rasters to be cropped, references included.
+    - out_dir (str): The output directory where the cropped rasters will be saved.
+    - sensors (tuple): The sensor names of the rasters cropped to the reference. Default: ('ndvi', 's1', 'palsar').
+    - num_workers (int): Number of processes cropping the tiles. Default: None, all cores.
+    - catalog (str): The tile catalog used to list the rasters instead of scanning the directory. Default: None.
+    - virtual (bool): Write .vrt files referencing the windows of the original rasters instead of copying the pixels. Default: False.
+
+    Returns:
+    - missing (list): (tile, sensor) pairs of the sensors missing for a tile.
+
+    Example Usage:
+    crop_tiles(path='../data/gee_data', out_dir='../data/croped_data',
+               sensors=('ndvi', 's1', 'palsar'))
+    """ # noqa
+
+    with open_catalog(catalog, path) as catalog:
+        ref_files = list_files(path, 'ref', catalog)
+
+        if len(ref_files) == 0:
+            ref_files = list_files(path, 'planet', catalog)
+
+        # Index the rasters of every sensor by tile ID
+        sensor_files = {sensor: {parse_tile(f)[0]: f for f in
+                                 list_files(path, sensor, catalog)
+                                 if parse_tile(f) is not None}
+                        for sensor in sensors}
+
+    tasks = []
+    missing = []
+    for ref_file in ref_files:
+        tile = parse_tile(ref_file)[0]
+        to_crop_files = []
+        for sensor in sensors:
+            if tile in sensor_files[sensor]:
+                to_crop_files.append(sensor_files[sensor][tile])
+            else:
+                missing.append((tile, sensor))
+        tasks.append((ref_file, to_crop_files, out_dir, virtual))
+
+    with multiprocessing.Pool(num_workers) as pool:
+        for _ in tqdm(pool.imap_unordered(_crop_tile, tasks, chunksize=16),
+                      total=len(tasks), desc='Cropping tiles'):
+            pass
+
+    if len(missing) > 0:
+        warnings.warn(f"{len(missing)} sensor rasters missing, "
+                      f"e.g. {missing[0]}")
+
+    return missing
@@ -28,7 +28,9 @@ for directory in directories:
     for filename in os.listdir(directory):
         file_path = os.path.join(directory, filename)
 
-        # Check if the path is a file and matches the pattern
-        if os.path.isfile(file_path) and filename.endswith('.tif'):
+        # Check if the path is a file and matches the pattern, the
+        # GeoTIFFs and the virtual crops alike
+        if (os.path.isfile(file_path) and
+                filename.endswith(('.tif', '.vrt'))):
             # Remove the file
             os.remove(file_path)
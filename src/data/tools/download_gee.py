@@ -1,28 +1,50 @@
 '''Module to download image chips from GEE'''
 
 import ee
+import functools
+import hashlib
 import logging
 import multiprocessing
 import os
 import requests
 import shutil
-from retry import retry
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from src.data.tools.bulk_export import cut_chips, group_chips
+from src.data.tools.chip_naming import chip_filename
+from src.data.tools.chip_planner import buffer_bounds, plan_chip
+from src.data.tools.cog import cog_record
+from src.data.tools.download_manifest import DownloadManifest
+from src.data.tools.telemetry import write_report
 
+logger = logging.getLogger(__name__)
 
-@retry(tries=10, delay=1, backoff=2)
-def getResult(index, point, image, res, dir, size, sulfix):
+# Retry policy of the chip and region requests
+TRIES = 10
+DELAY = 1
+BACKOFF = 2
+
+
+def getChipURL(point, image, res, chip_size=None):
     """
-    Helper function to download image chips for a given point.
+    Helper function to generate the download URL of the chip for a given point.
 
     Parameters:
-    - index (int): The index of the point.
     - point (dict): The coordinates of the point.
     - image (ee.Image): The image to download chips from.
     - res (int): The desired output resolution of the chips in meters.
-    - dir (str): The directory to save the downloaded chips.
-    - size (int): The total number of points.
-    - sulfix (str): The suffix to add to the chip filenames.
-    """
+    - chip_size (int): Side in meters of the exact chip planned around the point. Default: None, download the 2000m buffer around the point.
+
+    Returns:
+    - url (str): The download URL of the chip.
+    """ # noqa
+    if chip_size is not None:
+        # Request exactly the final, pixel-aligned chip
+        return getRegionURL(plan_chip(*point['coordinates'], chip_size),
+                            image, res)
+
     # Convert point coordinates to an Earth Engine Geometry Point
     point = ee.Geometry.Point(point['coordinates'])
 
@@ -30,7 +52,7 @@ def getResult(index, point, image, res, dir, size, sulfix):
     region = point.buffer(2000).bounds()
 
     # Generate the download URL for the chip
-    url = image.getDownloadURL(
+    return image.getDownloadURL(
         {
             'region': region,
             'crs_transform': [res, 0, 0, 0, -res, 0],
@@ -39,39 +61,323 @@ def getResult(index, point, image, res, dir, size, sulfix):
         }
     )
 
-    ext = 'tif'
 
+def fetch_url(url, filename, chunk_size=1 << 20):
+    """
+    Stream a URL into a file, checking the transfer is not truncated.
+
+    The body is written to a temporary '.part' file that only replaces
+    the final file once the download is complete.
+
+    Parameters:
+    - url (str): The URL to download.
+    - filename (str): The file path to save the response body.
+    - chunk_size (int): Number of bytes written at a time. Default: 1 MiB.
+
+    Returns:
+    - nbytes (int): The number of bytes written.
+    - checksum (str): The SHA-256 checksum of the file.
+    """
     # Send a GET request to download the chip image
     r = requests.get(url, stream=True)
     if r.status_code != 200:
         r.raise_for_status()
 
+    expected = r.headers.get('Content-Length')
+    digest = hashlib.sha256()
+    nbytes = 0
+    part = filename + '.part'
+
+    try:
+        with open(part, 'wb') as out_file:
+            for chunk in iter(lambda: r.raw.read(chunk_size), b''):
+                out_file.write(chunk)
+                digest.update(chunk)
+                nbytes += len(chunk)
+
+        if expected is not None and nbytes != int(expected):
+            raise IOError(f"Truncated download for {filename}: "
+                          f"{nbytes} of {expected} bytes")
+
+        os.replace(part, filename)
+    except BaseException:
+        # do not leave a partial file behind when the transfer fails
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+
+    return nbytes, digest.hexdigest()
+
+
+def retry_call(fn, *args, tries=TRIES, delay=DELAY, backoff=BACKOFF):
+    """
+    Call a function, retrying it with an exponential backoff, and return
+    the number of retries alongside its result.
+
+    Parameters:
+    - fn (callable): The function to call.
+    - *args: The arguments of the function.
+    - tries (int): Maximum number of attempts. Default: 10.
+    - delay (float): Seconds to wait before the first retry. Default: 1.
+    - backoff (float): Multiplier applied to the delay after each retry. Default: 2.
+
+    Returns:
+    - result: The result of the function.
+    - retries (int): The number of failed attempts before it succeeded.
+    """ # noqa
+    for attempt in range(tries):
+        try:
+            return fn(*args), attempt
+        except Exception as e:
+            if attempt == tries - 1:
+                raise
+            logger.debug('%s, retrying in %s seconds', e, delay)
+            time.sleep(delay)
+            delay *= backoff
+
+
+def _fetch_chip(index, point, image, res, dir, size, sulfix,
+                chip_size=None):
+    url = getChipURL(point, image, res, chip_size)
+
     # Prepare the file path and name for saving the chip image
-    folder = os.path.abspath(dir)
-    prefix = 'tile_'
-    basename = str(index).zfill(len(str(size)))
-    filename = f"{folder}/{prefix}{basename}{sulfix}.{ext}"
+    filename = chip_filename(index, dir, size, sulfix)
 
     # Save the chip image to the specified directory
-    with open(filename, 'wb') as out_file:
-        shutil.copyfileobj(r.raw, out_file)
+    nbytes, checksum = fetch_url(url, filename)
+
+    return {'file': os.path.basename(filename), 'status': 'complete',
+            'bytes': nbytes, 'sha256': checksum}
+
+
+def _download_chip(args):
+    """
+    Download a chip and turn a final failure into a 'failed' record, so a
+    single chip does not abort the whole run. The record also holds the
+    telemetry of the download.
+    """
+    index, point, image, res, dir, size, sulfix, chip_size = args
+    started = time.time()
+    try:
+        record, retries = retry_call(_fetch_chip, index, point, image, res,
+                                     dir, size, sulfix, chip_size)
+    except Exception as e:
+        filename = chip_filename(index, dir, size, sulfix)
+        logger.warning('Failed to download %s: %s', filename, e)
+        record = {'file': os.path.basename(filename), 'status': 'failed',
+                  'bytes': 0, 'sha256': None, 'error': repr(e)}
+        retries = TRIES - 1
+
+    finished = time.time()
+    record.update({'started': started, 'finished': finished,
+                   'latency': finished - started, 'retries': retries})
+    return record
+
+
+def getRegionURL(bounds, image, res):
+    """
+    Helper function to generate the download URL of an export region.
+
+    Parameters:
+    - bounds (tuple): The pixel-aligned EPSG:3857 bounds of the region.
+    - image (ee.Image): The image to download the region from.
+    - res (int): The desired output resolution in meters.
+
+    Returns:
+    - url (str): The download URL of the region.
+    """
+    region = ee.Geometry.Rectangle(list(bounds), 'EPSG:3857', False)
+
+    return image.getDownloadURL(
+        {
+            'region': region,
+            'crs_transform': [res, 0, 0, 0, -res, 0],
+            'crs': 'EPSG:3857',
+            'format': "GEO_TIFF"
+        }
+    )
+
+
+def _fetch_region(bounds, image, res, filename):
+    url = getRegionURL(bounds, image, res)
+    fetch_url(url, filename)
+
+
+def _failed_chips(chips, dir, size, sulfix, error):
+    return [{'file': os.path.basename(chip_filename(index, dir, size,
+                                                    sulfix)),
+             'status': 'failed', 'bytes': 0, 'sha256': None,
+             'error': error} for index, _ in chips]
+
+
+def _region_telemetry(records, region, started, retries):
+    """
+    Add the telemetry of an export region to the records of its chips.
+    """
+    finished = time.time()
+    for record in records:
+        record.update({'region': os.path.basename(region),
+                       'started': started, 'finished': finished,
+                       'latency': finished - started, 'retries': retries})
+    return records
+
+
+def _download_region(args):
+    """
+    Download an export region and cut its chips, turning a final failure
+    into 'failed' records for all of them.
+    """
+    filename, bounds, chips, image, res, dir, size, sulfix = args
+    started = time.time()
+    try:
+        _, retries = retry_call(_fetch_region, bounds, image, res, filename)
+        records = cut_chips(filename, chips, dir, size, sulfix)
+    except Exception as e:
+        logger.warning('Failed to export region %s: %s', bounds, e)
+        records = _failed_chips(chips, dir, size, sulfix, repr(e))
+        retries = TRIES - 1
+    return _region_telemetry(records, filename, started, retries)
+
+
+def _get_page(points, page_size, offset, id_column=None):
+    """
+    Retrieve the (index, coordinates) of one page of points, the index being
+    the id_column property or the position in the collection.
+    """
+    page = ee.FeatureCollection(points.toList(page_size, offset))
+    if id_column is None:
+        return list(enumerate(page.aggregate_array('.geo').getInfo(),
+                              offset))
+
+    page = ee.Dictionary({'ids': page.aggregate_array(id_column),
+                          'geo': page.aggregate_array('.geo')}).getInfo()
+    if len(page['ids']) != len(page['geo']):
+        raise ValueError(f"some points have no {id_column} property")
+    return [(int(index), point)
+            for index, point in zip(page['ids'], page['geo'])]
+
+
+def iter_points(points: ee.FeatureCollection, size: int, page_size=5000,
+                id_column=None):
+    """
+    Stream the coordinates of a FeatureCollection page by page.
+
+    Earth Engine does not guarantee the same order across separate toList
+    calls, so the collection is sorted by id_column, or system:index, once
+    before paging. The pages then neither overlap nor skip points, and a
+    point keeps its index between a run and its resume.
+
+    The next page is requested in a background thread while the current
+    one is being consumed, so the downloads do not stall between pages.
+
+    Parameters:
+    - points (ee.FeatureCollection): The points to retrieve.
+    - size (int): The total number of points.
+    - page_size (int): Number of points requested per call. Default: 5000.
+    - id_column (str): The property holding the point IDs used as index, e.g. 'point_id'. Default: None, the position in the collection sorted by system:index.
+
+    Yields:
+    - (index, point): The index of the point and its GeoJSON geometry.
+
+    Example Usage:
+    for index, point in iter_points(ee.FeatureCollection("points_collection_id"), 120000):
+        ...
+    """ # noqa
+    offsets = range(0, size, page_size)
+    if len(offsets) == 0:
+        return
+    points = points.sort(id_column or 'system:index')
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(_get_page, points, page_size, offsets[0],
+                                 id_column)
+        for i, offset in enumerate(offsets):
+            page = future.result()
+            if i + 1 < len(offsets):
+                future = executor.submit(_get_page, points, page_size,
+                                         offsets[i + 1], id_column)
+            yield from page
+
+
+def request_params(image, points, res, chip_size, bulk, cog, cog_compress,
+                   id_column):
+    """
+    Describe a GetImageChips request for the download manifest. The image
+    and the points are identified by the hash of their serialized
+    expression, so computed images are told apart too.
+    """
+    def expression_hash(obj):
+        return hashlib.sha256(obj.serialize().encode()).hexdigest()
+
+    return {'image': expression_hash(image),
+            'points': expression_hash(points),
+            'res': res,
+            'chip_size': chip_size,
+            'mode': 'bulk' if bulk else 'chip',
+            'cog': cog_compress if cog else None,
+            'id_column': id_column}
 
 
 def GetImageChips(download_image: ee.Image,
                   out_resolution: int,
                   points: ee.FeatureCollection,
                   out_dir: str,
-                  sulfix: str
+                  sulfix: str,
+                  resume=True,
+                  verify_checksum=True,
+                  backend='process',
+                  concurrency=256,
+                  adaptive=True,
+                  page_size=5000,
+                  bulk=False,
+                  region_pixels=2048,
+                  cog=False,
+                  cog_compress='DEFLATE',
+                  report=True,
+                  chip_size=None,
+                  id_column=None
                   ):
     """
     Function to download image chips from a Google Earth Engine image.
 
+    The points are retrieved in pages that are streamed straight into the
+    download queue, so downloads start while later pages are fetched.
+    In bulk mode the points are grouped into larger export regions that
+    are downloaded once each, and the chips are cut locally with windowed
+    reads, keeping the same file names.
+
+    Optionally every finished chip is rewritten as a tiled, compressed
+    Cloud-Optimized GeoTIFF by a process pool running alongside the
+    downloads.
+
+    Every chip is recorded in a download manifest stored in out_dir, along
+    with the parameters of the request. When resuming, chips that are
+    complete and valid on disk are skipped and only the missing, truncated
+    or failed ones, or those downloaded with other parameters, are
+    downloaded again.
+
     Parameters:
     - download_image (ee.Image): The image from which to extract the chips.
     - out_resolution (int): The desired output resolution of the chips in meters.
     - points (ee.FeatureCollection): The points or locations where the chips will be extracted.
     - out_dir (str): The directory to save the downloaded chips.
     - suffix (str): The suffix to add to the chip filenames.
+    - resume (bool): Skip the chips already recorded as complete in the manifest by a run with the same image, points, resolution, chip size, bulk and COG settings. Default: True.
+    - verify_checksum (bool): Check the SHA-256 of the chips on disk before skipping them. Default: True.
+    - backend (str): 'process' to download with a pool of 25 processes, or 'async' to download from a single process with asyncio and pooled keep-alive connections. Default: 'process'.
+    - concurrency (int): Maximum number of in-flight requests of the 'async' backend. Default: 256.
+    - adaptive (bool): Let the 'async' backend grow and shrink the in-flight requests with the observed 429/5xx rate, up to concurrency. Default: True.
+    - page_size (int): Number of points retrieved per request to Earth Engine. Default: 5000.
+    - bulk (bool): Download export regions grouping several chips and cut the chips locally. Default: False.
+    - region_pixels (int): Maximum side in pixels of the bulk export regions. Lower it for images with many bands, the download request is limited to 48 MB. Default: 2048.
+    - cog (bool): Rewrite the chips as Cloud-Optimized GeoTIFFs with internal overviews. Default: False.
+    - cog_compress (str): The compression codec of the COGs, e.g. 'DEFLATE' or 'ZSTD'. Default: 'DEFLATE'.
+    - chip_size (int): Side in meters of the chips. When set, every chip is planned with exactly this extent, pixel-aligned for the 5m, 10m and 20m sensors (2000 gives the final 400x400 Planet chips), instead of the oversized 2000m buffer around the point that crop_image cuts down afterwards. Default: None.
+    - report (bool): Write the per-chip latency, bytes, retries and failure reason of the run to download_report<suffix>.csv, and a summary with percentiles, throughput over time and the slowest chips to download_report<suffix>.json. Default: True.
+    - id_column (str): The property of the points holding their stable IDs, e.g. the 'point_id' written by create_sampling_points, used to name the chips tile_<id><suffix>. Pass it to pair the chips with the masks of rasterize_chips. Default: None, the chips are named after the position of the points sorted by system:index.
+
+    Returns:
+    - failed (list): File names of the chips that could not be downloaded.
 
     Example Usage:
     GetImageChips(ee.Image("image_id"), 10, ee.FeatureCollection("points_collection_id"), "/path/to/save/chips", "_chip")
@@ -82,17 +388,178 @@ def GetImageChips(download_image: ee.Image,
     # Configure logging
     logging.basicConfig()
 
-    # Limit the number of points to process (5000 in this case)
-    items = points.limit(5000).aggregate_array('.geo').getInfo()
+    manifest = DownloadManifest(out_dir, verify_checksum=verify_checksum,
+                                params=request_params(
+                                    download_image, points, out_resolution,
+                                    chip_size, bulk, cog, cog_compress,
+                                    id_column))
 
-    # Prepare a list of download items to process in parallel
-    download_items = [(a, b, download_image,
+    # Stream the download items to process in parallel page by page,
+    # skipping the chips already downloaded by a previous run
+    download_items = ((a, b, download_image,
                        out_resolution, out_dir,
-                       size, sulfix) for a, b in enumerate(items)]
+                       size, sulfix, chip_size)
+                      for a, b in iter_points(points, size, page_size,
+                                              id_column)
+                      if not (resume and manifest.is_complete(
+                          chip_filename(a, out_dir, size, sulfix))))
+
+    logger.info('%d points to process', size)
+
+    failed = []
+    records = []
+    lock = threading.Lock()
+
+    def record_chip(record):
+        with lock:
+            manifest.record(record)
+            records.append(record)
+            if record['status'] != 'complete':
+                failed.append(record['file'])
+
+    converter = None
+    if cog:
+        # Chips are converted while the next ones are being downloaded,
+        # and only recorded once they are in their final layout
+        converter = ProcessPoolExecutor()
+
+        def on_converted(future):
+            record_chip(future.result())
+
+        def on_record(record):
+            if record['status'] != 'complete':
+                record_chip(record)
+                return
+            future = converter.submit(cog_record, record, out_dir,
+                                      compress=cog_compress)
+            future.add_done_callback(on_converted)
+    else:
+        on_record = record_chip
+
+    try:
+        if bulk:
+            _get_bulk_chips(download_items, download_image, out_resolution,
+                            out_dir, size, sulfix, backend, concurrency,
+                            adaptive, region_pixels, chip_size, on_record)
+
+        elif backend == 'async':
+            # Imported here so the process backend does not require aiohttp
+            from src.data.tools.async_download import download_async
+
+            jobs = ((chip_filename(a, out_dir, size, sulfix),
+                     functools.partial(getChipURL, b, download_image,
+                                       out_resolution, chip_size))
+                    for a, b, *_ in download_items)
+            stats = download_async(jobs, on_record, concurrency=concurrency,
+                                   adaptive=adaptive)
+            if stats is not None:
+                logger.info('Effective throughput: %.1f chips/s, %.2f MB/s',
+                            stats['requests_per_s'],
+                            stats['bytes_per_s'] / 1e6)
+
+        elif backend == 'process':
+            # Create a multiprocessing pool with 25 workers
+            with multiprocessing.Pool(25) as pool:
+                # Download image chips in parallel using the _download_chip
+                # function, recording each chip in the manifest as soon as it
+                # is finished
+                for record in pool.imap_unordered(_download_chip,
+                                                  download_items):
+                    on_record(record)
+                pool.close()
+                pool.join()
+
+        else:
+            raise ValueError(f"Unknown download backend: {backend}")
+    finally:
+        # also on errors, so the converter processes do not leak
+        if converter is not None:
+            converter.shutdown(wait=True)
+
+    if report:
+        summary = write_report(records, out_dir,
+                               name='download_report' + sulfix)
+        logger.info('%d chips downloaded, %d failed, %.1f chips/s',
+                    summary.get('complete', 0), summary.get('failed', 0),
+                    summary.get('chips_per_s', 0))
+
+    return failed
+
+
+def _get_bulk_chips(download_items, image, res, out_dir, size, sulfix,
+                    backend, concurrency, adaptive, region_pixels, chip_size,
+                    on_record):
+    """
+    Download the chips of GetImageChips through export regions.
+    """
+    # Grouping needs every point, but only their coordinates are kept
+    if chip_size is not None:
+        chips = [(a, plan_chip(*b['coordinates'], chip_size))
+                 for a, b, *_ in download_items]
+    else:
+        chips = [(a, buffer_bounds(*b['coordinates'], res))
+                 for a, b, *_ in download_items]
+    regions = group_chips(chips, res, region_pixels)
+    logger.info('%d chips grouped into %d export regions',
+                len(chips), len(regions))
+
+    tmp_dir = tempfile.mkdtemp(prefix='.regions_', dir=out_dir)
+    region_items = [(os.path.join(tmp_dir, f"region_{k}.tif"), bounds,
+                     members, image, res, out_dir, size, sulfix)
+                    for k, (bounds, members) in enumerate(regions)]
+
+    if backend == 'async':
+        from src.data.tools.async_download import download_async
+
+        members = {item[0]: item[2] for item in region_items}
+        jobs = ((item[0], functools.partial(getRegionURL, item[1], image,
+                                            res))
+                for item in region_items)
+
+        def on_cut(chips, region, future):
+            try:
+                records = future.result()
+            except Exception as e:
+                logger.warning('Failed to cut chips: %s', e)
+                records = _failed_chips(chips, out_dir, size, sulfix,
+                                        repr(e))
+            _region_telemetry(records, region['file'], region['started'],
+                              region['retries'])
+            for record in records:
+                on_record(record)
+
+        # Chips are cut in a process pool while other regions download
+        with ProcessPoolExecutor() as cutter:
+
+            def on_region(record):
+                filename = os.path.join(tmp_dir, record['file'])
+                chips = members[filename]
+                if record['status'] == 'complete':
+                    future = cutter.submit(cut_chips, filename, chips,
+                                           out_dir, size, sulfix)
+                    future.add_done_callback(
+                        functools.partial(on_cut, chips, record))
+                else:
+                    records = _failed_chips(chips, out_dir, size, sulfix,
+                                            record.get('error'))
+                    _region_telemetry(records, record['file'],
+                                      record['started'], record['retries'])
+                    for chip in records:
+                        on_record(chip)
+
+            download_async(jobs, on_region, concurrency=concurrency,
+                           adaptive=adaptive)
+
+    elif backend == 'process':
+        with multiprocessing.Pool(25) as pool:
+            for records in pool.imap_unordered(_download_region,
+                                               region_items):
+                for record in records:
+                    on_record(record)
+            pool.close()
+            pool.join()
 
-    # Create a multiprocessing pool with 25 workers
-    pool = multiprocessing.Pool(25)
+    else:
+        raise ValueError(f"Unknown download backend: {backend}")
 
-    # Download image chips in parallel using the getResult function
-    pool.starmap(getResult, download_items)
-    pool.close()
+    shutil.rmtree(tmp_dir, ignore_errors=True)
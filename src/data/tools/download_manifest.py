@@ -0,0 +1,105 @@
+'''Module to keep a persistent record of the downloaded image chips'''
+
+import hashlib
+import json
+import os
+
+MANIFEST_NAME = 'download_manifest.jsonl'
+
+
+def file_checksum(path: str, chunk_size=1 << 20):
+    """
+    Compute the SHA-256 checksum of a file.
+
+    Parameters:
+    - path (str): The file path.
+    - chunk_size (int): Number of bytes read at a time. Default: 1 MiB.
+
+    Returns:
+    - checksum (str): The hexadecimal SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadManifest:
+    """
+    Append-only record of the chips downloaded into a directory.
+
+    Each line of the manifest is a JSON record with the chip file name,
+    its status ('complete' or 'failed'), the number of bytes written, the
+    SHA-256 checksum and the parameters of the request that produced it.
+    When a chip appears more than once the last record wins, so a re-run
+    only has to append the chips it fetched. A chip recorded with other
+    parameters, e.g. another image or resolution, is not complete.
+
+    Parameters:
+    - out_dir (str): The directory holding the chips and the manifest.
+    - verify_checksum (bool): Recompute the checksum of the chips on disk
+    before skipping them. Default: True.
+    - params (dict): The JSON-serializable parameters of the request,
+    stored in every record. Default: None.
+
+    Example Usage:
+    manifest = DownloadManifest('data/gee_data', params={'res': 10})
+    if not manifest.is_complete('data/gee_data/tile_0001_s1.tif'):
+        ...
+    """
+    def __init__(self, out_dir: str, verify_checksum=True, params=None):
+        self.path = os.path.join(os.path.abspath(out_dir), MANIFEST_NAME)
+        self.verify_checksum = verify_checksum
+        # Round-trip through JSON to compare with the records read back
+        self.params = json.loads(json.dumps(params))
+        self.records = {}
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # A run killed mid-write leaves a partial last line
+                        continue
+                    self.records[record['file']] = record
+
+    def is_complete(self, filename: str):
+        """
+        Check whether a chip was fully downloaded with the parameters of
+        this manifest and is still valid on disk, i.e. it exists with the
+        recorded size and checksum.
+        """
+        record = self.records.get(os.path.basename(filename))
+        if record is None or record['status'] != 'complete':
+            return False
+
+        if record.get('params') != self.params:
+            return False
+
+        if not os.path.exists(filename):
+            return False
+
+        if os.path.getsize(filename) != record['bytes']:
+            return False
+
+        if self.verify_checksum:
+            return file_checksum(filename) == record['sha256']
+
+        return True
+
+    def record(self, record: dict):
+        """
+        Append a chip record to the manifest and flush it to disk, along
+        with the parameters of this manifest.
+        """
+        record = dict(record, params=self.params)
+        self.records[record['file']] = record
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
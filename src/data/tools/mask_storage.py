@@ -0,0 +1,45 @@
+'''Module with the storage options of the binary mask rasters'''
+
+# Side in pixels of the internal tiles of the masks
+MASK_BLOCKSIZE = 256
+
+
+def mask_profile(compress='DEFLATE', nbits=1, blocksize=MASK_BLOCKSIZE,
+                 burn_value=None):
+    """
+    Build the GeoTIFF creation options to store a binary mask as a tiled,
+    compressed and optionally bit-packed raster. GDAL unpacks 1-bit rasters
+    to uint8 on read, so the readers get the same 0/1 arrays.
+
+    Parameters:
+    - compress (str): The compression of the GeoTIFF, e.g. 'DEFLATE', 'ZSTD' or None. Default: 'DEFLATE'.
+    - nbits (int): Bits per pixel, 1 to bit-pack the mask or 8 for plain uint8. Default: 1.
+    - blocksize (int): The side in pixels of the internal tiles. Default: 256.
+    - burn_value (int): The value burnt into the mask, which must be 0 or 1 when nbits is 1. Default: None, not checked.
+
+    Returns:
+    - profile (dict): Options to update the rasterio profile with.
+
+    Example Usage:
+    profile.update(mask_profile(compress='ZSTD', nbits=1))
+    """ # noqa
+    if nbits not in (1, 8):
+        raise ValueError(f"nbits must be 1 or 8, got {nbits}")
+    if nbits == 1 and burn_value is not None and burn_value not in (0, 1):
+        # A 1-bit raster silently keeps only the lowest bit of the value
+        raise ValueError(f"burn_value must be 0 or 1 with nbits=1, "
+                         f"got {burn_value}")
+
+    profile = {
+        'driver': 'GTiff',
+        'dtype': 'uint8',
+        'tiled': True,
+        'blockxsize': blocksize,
+        'blockysize': blocksize,
+    }
+    if compress is not None:
+        profile['compress'] = compress
+    if nbits == 1:
+        profile['nbits'] = 1
+
+    return profile
@@ -0,0 +1,104 @@
+'''Module to pack normalized chips into memory-mapped arrays'''
+
+import json
+import numpy as np
+import os
+import torch
+
+INDEX_NAME = 'index.json'
+
+
+def pack_arrays(arrays: dict, out_dir: str, tiles=None):
+    """
+    Pack the chips of every sensor into one contiguous .npy array each, plus
+    an index.json describing them. Sample i of every array belongs to the
+    same tile.
+
+    Parameters:
+    - arrays (dict): {name: (paths, read)}, where read(path) returns the normalized array of a chip in its final layout.
+    - out_dir (str): The directory of the packed store.
+    - tiles (list): The tile IDs of the samples, kept in the index. Default: None.
+
+    Returns:
+    - index (dict): The content of index.json.
+
+    Example Usage:
+    pack_arrays({'image': (img_files, read_image), 'mask': (mask_files, read_mask)}, 'data/packed/train')
+    """ # noqa
+    os.makedirs(out_dir, exist_ok=True)
+    lengths = {len(paths) for paths, _ in arrays.values()}
+    if len(lengths) != 1:
+        raise ValueError(f"the arrays have different lengths: {lengths}")
+    length = lengths.pop()
+    if length == 0:
+        raise ValueError("there are no chips to pack")
+    if tiles is not None and len(tiles) != length:
+        raise ValueError(f"{len(tiles)} tile IDs for {length} chips")
+
+    index = {'length': length, 'tiles': tiles, 'arrays': {}}
+    for name, (paths, read) in arrays.items():
+        filename = name + '.npy'
+        first = read(paths[0])
+        packed = np.lib.format.open_memmap(os.path.join(out_dir, filename),
+                                           mode='w+', dtype=first.dtype,
+                                           shape=(len(paths),) + first.shape)
+        packed[0] = first
+        for i, path in enumerate(paths[1:], start=1):
+            packed[i] = read(path)
+        packed.flush()
+        del packed
+
+        index['arrays'][name] = {
+            'file': filename,
+            'dtype': str(first.dtype),
+            'shape': [len(paths), *first.shape],
+            'sources': [os.path.abspath(path) for path in paths],
+        }
+
+    with open(os.path.join(out_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+
+    return index
+
+
+class PackedStore:
+    """
+    Read-only view of a store written by pack_arrays. The arrays are memory
+    mapped on first access in every process, so the store can be shared
+    with the DataLoader workers, and samples are served as zero-copy
+    tensors.
+
+    Parameters:
+    - path (str): The directory of the packed store.
+
+    Example Usage:
+    store = PackedStore('data/packed/train')
+    sample = store[0]  # {'image': tensor, 'mask': tensor}
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME)) as f:
+            self.index = json.load(f)
+        self.arrays = None
+
+    def __getstate__(self):
+        # the memory maps are reopened by every worker
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def open(self):
+        # copy-on-write maps are writable, as torch expects, while the
+        # files are never modified
+        self.arrays = {name: np.load(os.path.join(self.path, meta['file']),
+                                     mmap_mode='c')
+                       for name, meta in self.index['arrays'].items()}
+        return self.arrays
+
+    def __len__(self):
+        return self.index['length']
+
+    def __getitem__(self, index):
+        arrays = self.arrays if self.arrays is not None else self.open()
+        return {name: torch.from_numpy(array[index])
+                for name, array in arrays.items()}
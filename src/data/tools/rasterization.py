@@ -1,27 +1,94 @@
 """Module to rasterize the reference polygons."""
 
+import multiprocessing
+import numpy as np
 import rasterio as rio
 from rasterio.features import rasterize
 from rasterio.transform import Affine
+from rasterio.windows import Window, bounds as window_bounds
 import geopandas as gpd
+import shapely
 import warnings
+from src.data.tools.chip_naming import POINT_ID, chip_filename
+from src.data.tools.chip_planner import CHIP_SIZE, plan_chip
+from src.data.tools.mask_storage import mask_profile
+
+# Side in pixels of the internal tiles of the output GeoTIFF
+TILE_SIZE = 256
+
+# Polygons shared with the worker processes, set by _init_worker
+_geometries = None
+_tree = None
+
+
+def _init_worker(geometries):
+    global _geometries, _tree
+    _geometries = geometries
+    _tree = None
+
+
+def _rasterize_block(args):
+    """
+    Burn the candidate polygons of one block of the raster.
+    """
+    window, transform, candidates, burn_value = args
+    data = rasterize(
+        shapes=[(geom, burn_value) for geom in _geometries[candidates]],
+        out_shape=(window.height, window.width),
+        transform=transform,
+        fill=0,
+        default_value=0,
+        dtype=rio.uint8,
+    )
+    return window, data
+
+
+def _iter_blocks(geometries, transform, num_rows, num_cols, block_size,
+                 burn_value):
+    """
+    Partition the raster into windows of block_size x block_size pixels,
+    yielding only the windows with candidate polygons.
+    """
+    tree = shapely.STRtree(geometries)
+    for row in range(0, num_rows, block_size):
+        for col in range(0, num_cols, block_size):
+            window = Window(col, row, min(block_size, num_cols - col),
+                            min(block_size, num_rows - row))
+            extent = shapely.box(*window_bounds(window, transform))
+            candidates = tree.query(extent)
+            if len(candidates) == 0:
+                continue
+            yield (window, rio.windows.transform(window, transform),
+                   np.sort(candidates), burn_value)
 
 
 def rasterize_polygon(path_file: str, pixel_res: int,
-                      out_dir: str, burn_value=1):
+                      out_dir: str, burn_value=1, block_size=4096,
+                      num_workers=None, compress=None, nbits=8):
     """
     Function to rasterize polygons to start the pre-processing for ingesting
     in the CNN.
 
+    The raster is written as a tiled GeoTIFF one block at a time. Each block
+    only burns the polygons found through a spatial index and the blocks are
+    rasterized in a process pool, so peak memory depends on the block size
+    and not on the extent of the shapefile. Blocks without polygons are left
+    as nodata.
+
     Parameters:
     - path_file (str): The file path to the input shapefile containing the polygons.
     - pixel_res (int): The pixel resolution in meters.
     - out_dir (str): The output directory to save the rasterized polygons.
     - burn_value (int): The value assigned to the pixels inside the polygons. Default is 1.
+    - block_size (int): Side in pixels of the blocks rasterized at once. Preferably a multiple of 256, the tile size. Default: 4096.
+    - num_workers (int): Number of processes rasterizing the blocks. Default: None, all cores.
+    - compress (str): The compression of the GeoTIFF, e.g. 'DEFLATE' or 'ZSTD'. Default: None, uncompressed.
+    - nbits (int): Bits per pixel, 1 to bit-pack the mask. Requires burn_value 0 or 1, otherwise a ValueError is raised. Default: 8.
 
     Example Usage:
     rasterize_polygon('path/to/polygons.shp', 5, 'output_directory', burn_value=1)
     """ # noqa
+    profile = mask_profile(compress, nbits, TILE_SIZE, burn_value)
     shp = gpd.read_file(path_file)
 
     # Check the proj, everything must be in metric scale
@@ -39,27 +106,122 @@ def rasterize_polygon(path_file: str, pixel_res: int,
     raster = rio.open(
         raster_name,
         'w',
-        driver='GTiff',
         height=num_rows,
         width=num_cols,
         count=1,
-        dtype=rio.uint8,
         transform=transform,
         crs=shp.crs,
         nodata=0,
+        BIGTIFF='IF_SAFER',
+        **profile,
     )
 
-    # Rasterize geometries
-    rasterize_geom = [(geom, burn_value) for geom in shp.geometry]
+    # Rasterize geometries block by block
+    geometries = shp.geometry.values
+    blocks = _iter_blocks(geometries, transform, num_rows, num_cols,
+                          block_size, burn_value)
 
-    raster_image = rasterize(
-        shapes=rasterize_geom,
-        out_shape=(num_rows, num_cols),
-        transform=transform,
-        fill=0,
-        default_value=0,
-        dtype=rio.uint8,
-    )
+    with multiprocessing.Pool(num_workers, initializer=_init_worker,
+                              initargs=(geometries,)) as pool:
+        for window, data in pool.imap_unordered(_rasterize_block, blocks):
+            raster.write(data, 1, window=window)
 
-    raster.write(raster_image, 1)
     raster.close()
+
+
+def _rasterize_chip(args):
+    """
+    Rasterize the reference mask of one chip from the polygons inside it.
+    """
+    global _tree
+    if _tree is None:
+        _tree = shapely.STRtree(_geometries)
+
+    filename, bounds, pixel_res, burn_value, profile = args
+    width = round((bounds[2] - bounds[0]) / pixel_res)
+    height = round((bounds[3] - bounds[1]) / pixel_res)
+    transform = Affine(pixel_res, 0, bounds[0], 0, -pixel_res, bounds[3])
+
+    candidates = np.sort(_tree.query(shapely.box(*bounds)))
+    if len(candidates) == 0:
+        data = np.zeros((height, width), dtype=rio.uint8)
+    else:
+        data = rasterize(
+            shapes=[(geom, burn_value) for geom in _geometries[candidates]],
+            out_shape=(height, width),
+            transform=transform,
+            fill=0,
+            default_value=0,
+            dtype=rio.uint8,
+        )
+
+    with rio.open(filename, 'w', height=height, width=width, count=1,
+                  transform=transform, crs='EPSG:3857', nodata=0,
+                  **profile) as dst:
+        dst.write(data, 1)
+
+    return filename
+
+
+def rasterize_chips(points_path: str, path_file: str, out_dir: str,
+                    pixel_res=5, sulfix='_ref', burn_value=1,
+                    chip_size=CHIP_SIZE, num_workers=None,
+                    compress='DEFLATE', nbits=1, id_column=POINT_ID):
+    """
+    Rasterize the reference masks directly at the final grid of every chip,
+    replacing the rasterization of the whole polygon layer, the download of
+    the reference chips and crop_ref_img.
+
+    The chips are planned with plan_chip around the sampling points, so the
+    masks share the extent of the chips downloaded with the same chip_size,
+    and named tile_<id><sulfix>.tif after the point_id column written by
+    create_sampling_points. Download the imagery of the same points with
+    GetImageChips(id_column='point_id') so both sides name a chip after
+    the same point. Every chip only burns the polygons found through a
+    spatial index and the chips are rasterized in a process pool.
+
+    Parameters:
+    - points_path (str): Path to the sampling points, e.g. the points.gpkg from create_sampling_points.
+    - path_file (str): The file path to the input shapefile containing the polygons.
+    - out_dir (str): The output directory to save the masks.
+    - pixel_res (int): The pixel resolution in meters. Default: 5.
+    - sulfix (str): The suffix to add to the mask filenames. Default: '_ref'.
+    - burn_value (int): The value assigned to the pixels inside the polygons. Default is 1.
+    - chip_size (int): Side in meters of the chips. Default: 2000, 400x400 px at 5m.
+    - num_workers (int): Number of processes rasterizing the chips. Default: None, all cores.
+    - compress (str): The compression of the masks, e.g. 'DEFLATE', 'ZSTD' or None. Default: 'DEFLATE'.
+    - nbits (int): Bits per pixel, 1 to bit-pack the masks or 8 for plain uint8. Requires burn_value 0 or 1 when 1, otherwise a ValueError is raised. Default: 1.
+    - id_column (str): The column of unique point IDs naming the masks. None names them after the position of the points in the file, which only matches imagery downloaded from the same points in the same order. Default: 'point_id'.
+
+    Returns:
+    - files (list): The file paths of the masks.
+
+    Example Usage:
+    rasterize_chips('data/points.gpkg', 'path/to/polygons.shp', 'data/ref')
+    """ # noqa
+    profile = mask_profile(compress, nbits, burn_value=burn_value)
+    points = gpd.read_file(points_path).to_crs('EPSG:4326')
+    shp = gpd.read_file(path_file).to_crs('EPSG:3857')
+
+    size = len(points)
+    if id_column is None:
+        ids = range(size)
+    elif id_column not in points.columns:
+        raise ValueError(f"{points_path} has no {id_column} column, pass "
+                         f"id_column=None to name the masks by position")
+    elif not points[id_column].is_unique:
+        raise ValueError(f"the {id_column} column of {points_path} has "
+                         f"duplicated IDs")
+    else:
+        ids = points[id_column].astype(int)
+    chips = ((chip_filename(index, out_dir, size, sulfix),
+              plan_chip(point.x, point.y, chip_size), pixel_res, burn_value,
+              profile)
+             for index, point in zip(ids, points.geometry))
+
+    geometries = shp.geometry.values
+    with multiprocessing.Pool(num_workers, initializer=_init_worker,
+                              initargs=(geometries,)) as pool:
+        files = list(pool.imap(_rasterize_chip, chips, chunksize=64))
+
+    return files
@@ -0,0 +1,121 @@
+'''Module with an adaptive concurrency controller for GEE chip requests'''
+
+import asyncio
+import time
+
+
+def is_congestion(status=None, latency=None, target_latency=None):
+    """
+    Decide whether a finished request signals an overloaded server.
+
+    Parameters:
+    - status (int): The HTTP status, None for a transport error or timeout.
+    - latency (float): The request latency in seconds.
+    - target_latency (float): Latency above which the server is considered overloaded. Default: None, latency is ignored.
+
+    Returns:
+    - congested (bool): True for 429, 5xx, transport errors and slow responses.
+    """ # noqa
+    if status is None or status == 429 or status >= 500:
+        return True
+    if target_latency is not None and latency is not None:
+        return latency > target_latency
+    return False
+
+
+class AdaptiveLimiter:
+    """
+    Shared AIMD (additive increase, multiplicative decrease) limit on the
+    number of in-flight requests.
+
+    Every successful request grows the limit by increase / limit, i.e. by
+    `increase` per round trip of the whole window. A throttled (429),
+    failed (5xx, transport error) or slow request multiplies the limit by
+    `decrease`, at most once per cooldown so a burst of failures from the
+    same window only cuts it once.
+
+    Parameters:
+    - initial (int): Starting limit. Default: 16.
+    - minimum (int): Lowest limit. Default: 1.
+    - maximum (int): Highest limit. Default: 256.
+    - increase (float): Additive increase per window. Default: 1.
+    - decrease (float): Multiplicative decrease factor. Default: 0.5.
+    - target_latency (float): Latency in seconds above which requests count as congestion. Default: None.
+    - cooldown (float): Minimum seconds between two decreases. Default: 1.
+
+    Example Usage:
+    limiter = AdaptiveLimiter(initial=16, maximum=512)
+    await limiter.acquire()
+    ...
+    await limiter.release(status=200, latency=0.4, nbytes=1024)
+    print(limiter.stats())
+    """ # noqa
+    def __init__(self, initial=16, minimum=1, maximum=256, increase=1,
+                 decrease=0.5, target_latency=None, cooldown=1):
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.cooldown = cooldown
+
+        self.in_flight = 0
+        self.completed = 0
+        self.congested = 0
+        self.nbytes = 0
+        self.start = time.monotonic()
+        self.last_decrease = 0.
+        self._condition = asyncio.Condition()
+
+    async def acquire(self):
+        """
+        Wait until a request slot is free under the current limit.
+        """
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, status=None, latency=None, nbytes=0):
+        """
+        Free a request slot and adapt the limit to the request outcome.
+
+        Parameters:
+        - status (int): The HTTP status, None for a transport error.
+        - latency (float): The request latency in seconds.
+        - nbytes (int): The number of bytes transferred.
+        """
+        self.in_flight -= 1
+        now = time.monotonic()
+
+        if is_congestion(status, latency, self.target_latency):
+            self.congested += 1
+            if now - self.last_decrease >= self.cooldown:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.last_decrease = now
+        else:
+            if status is not None and status < 400:
+                self.completed += 1
+                self.nbytes += nbytes
+            self.limit = min(self.maximum,
+                             self.limit + self.increase / self.limit)
+
+        async with self._condition:
+            self._condition.notify_all()
+
+    def stats(self):
+        """
+        Report the current limit and the effective throughput.
+
+        Returns:
+        - stats (dict): limit, in_flight, completed, congested,
+        requests_per_s and bytes_per_s since the limiter was created.
+        """
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        return {'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'completed': self.completed,
+                'congested': self.congested,
+                'requests_per_s': self.completed / elapsed,
+                'bytes_per_s': self.nbytes / elapsed}
@@ -1,9 +1,10 @@
 from torch.utils.data import Dataset
 import numpy as np
 import rasterio
-import glob
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
+from src.data.tools.catalog import (list_files, open_catalog, pair_files,
+                                    parse_tile)
 
 def normalize_image(image, sensor:str):
     image = image.astype(np.float32)
@@ -21,10 +22,13 @@ def normalize_image(image, sensor:str):
     return image
 
 
-def gen_images(sensor: str, image_dir: str, gen:bool):
+def gen_images(sensor: str, image_dir: str, gen:bool, files=None):
     if gen:
         images = []
-        img_files = sorted(glob.glob(image_dir + '/*' + sensor + '.tif'))
+        if files is None:
+            img_files = list_files(image_dir, sensor)
+        else:
+            img_files = files[sensor]
         for img in img_files:
             with rasterio.open(img) as ds:
                 image = np.transpose(ds.read(), (1, 2, 0))
@@ -44,13 +48,23 @@ class RSDataset(Dataset):
                  ndvi=False,
                  s1=False,
                  palsar=False,
-                 planet=False):
+                 planet=False,
+                 catalog=None):
         self.image_dir = image_dir
         self.model = model
-        self.ndvi = gen_images('ndvi', image_dir, ndvi)
-        self.s1 = gen_images('s1', image_dir, s1)
-        self.palsar = gen_images('palsar', image_dir, palsar)
-        self.planet = gen_images('planet', image_dir, planet)
+        # pair the sensors by tile ID, the tile of every sample is kept in
+        # self.tiles
+        sensors = {'ndvi': ndvi, 's1': s1, 'palsar': palsar,
+                   'planet': planet}
+        with open_catalog(catalog, image_dir) as catalog:
+            files = pair_files({sensor: image_dir for sensor, gen
+                                in sensors.items() if gen}, catalog)
+        self.tiles = [parse_tile(path)[0] for path in
+                      next(iter(files.values()), [])]
+        self.ndvi = gen_images('ndvi', image_dir, ndvi, files)
+        self.s1 = gen_images('s1', image_dir, s1, files)
+        self.palsar = gen_images('palsar', image_dir, palsar, files)
+        self.planet = gen_images('planet', image_dir, planet, files)
 
     # Define len function
     def __len__(self):
@@ -2,12 +2,13 @@ from src.model_fusion.model import UNET as unet_fusion
 from src.model_ndvi.model import UNET as unet_ndvi
 from src.model_planet.model import UNET as unet_planet
 from src.data.tools.rs_dataset import RSDataset
+from src.data.tools.mask_storage import mask_profile
+from src.data.tools.catalog import open_catalog, tile_index
 from torch.utils.data import DataLoader
 from skimage.exposure import rescale_intensity, adjust_gamma
 import cv2
 import matplotlib.pyplot as plt
 import rasterio
-import glob
 import numpy as np
 import torch
 import os
@@ -23,6 +24,12 @@ IMG_DIR = '../data/croped_data'
 SAVE_DIR = '../data/predictions/'
 CHECKPOINT_DIR = '../checkpoints/'
 
+# Sensors of the tiles segmented by every model. segment_images predicts the
+# tiles with all of them, in tile ID order.
+MODEL_SENSORS = {'fusion': ('ndvi', 's1', 'palsar'),
+                 'ndvi': ('ndvi',),
+                 'rgbn': ('planet',)}
+
 def normalize_image(image):
     # Convert the image to floating-point values
     image = image.astype(np.float32)
@@ -31,26 +38,36 @@ def normalize_image(image):
     return image
 
 
+def model_tiles(model_name: str, img_dir=IMG_DIR, catalog=None):
+    """
+    Return the {tile: {sensor: path}} of the tiles segmented by a model, in
+    the order of the predictions of segment_images.
+    """
+    sources = {sensor: img_dir for sensor in MODEL_SENSORS[model_name]}
+    return tile_index(sources, catalog)
+
+
 def segment_images(model_name:str, roi:int,
-                  img_dir=IMG_DIR):
+                  img_dir=IMG_DIR, catalog=None):
     
     if model_name == 'fusion':
         ds = RSDataset(img_dir, model=model_name,
-                       ndvi=True, s1=True, palsar=True)
+                       ndvi=True, s1=True, palsar=True, catalog=catalog)
         model = unet_fusion(in_channels=3, out_channels=1).to(DEVICE) 
         if roi == 1:
             weights = CHECKPOINT_DIR + 'fusion.pth.tar'
         if roi == 2:
             weights = CHECKPOINT_DIR + 'fusion_ne.pth.tar'
     if model_name == 'ndvi':
-        ds = RSDataset(img_dir, model=model_name, ndvi=True)
+        ds = RSDataset(img_dir, model=model_name, ndvi=True, catalog=catalog)
         model = unet_ndvi(in_channels=3, out_channels=1).to(DEVICE) 
         if roi == 1:
             weights = CHECKPOINT_DIR + 'ndvi.pth.tar'
         if roi == 2:
             weights = CHECKPOINT_DIR + 'ndvi_ne.pth.tar'
     if model_name == 'rgbn':
-        ds = RSDataset(img_dir, model=model_name, planet=True)
+        ds = RSDataset(img_dir, model=model_name, planet=True,
+                       catalog=catalog)
         model = unet_planet(in_channels=4, out_channels=1).to(DEVICE) 
         if roi == 1:
             weights = CHECKPOINT_DIR + 'planet.pth.tar'
@@ -95,21 +112,32 @@ def segment_images(model_name:str, roi:int,
 
     
 def rgb_predictions(preds_fusion:None, preds_ndvi:None, preds_rgbn:None,
-                    roi: int, img_dir=IMG_DIR):
-    
-    images = []
-    files_planet = sorted(glob.glob(img_dir + '/*planet.tif'))
-    for tile_number in range(len(files_planet)):
-        with rasterio.open(files_planet[tile_number]) as planet_ds:
-            planet = normalize_image(np.transpose(planet_ds.read()[0:3], (1, 2, 0)))
-            planet = adjust_gamma(planet, 0.8)
-            images.append(planet)
-
-    for idx in range(len(images)):
-        image_planet = images[idx]
-        seg_fusion = preds_fusion[idx].astype(np.uint8)
-        seg_ndvi = preds_ndvi[idx].astype(np.uint8)
-        seg_rgbn = preds_rgbn[idx].astype(np.uint8)
+                    roi: int, img_dir=IMG_DIR, catalog=None):
+
+    preds = {'fusion': preds_fusion, 'ndvi': preds_ndvi, 'rgbn': preds_rgbn}
+    with open_catalog(catalog, img_dir) as catalog:
+        files_planet = tile_index({'planet': img_dir}, catalog)
+        # key the predictions of every model by the tile they come from
+        for model_name, model_preds in preds.items():
+            tiles = model_tiles(model_name, img_dir, catalog)
+            if len(tiles) != len(model_preds):
+                raise ValueError(f"{len(model_preds)} {model_name} "
+                                 f"predictions for {len(tiles)} tiles in "
+                                 f"{img_dir}")
+            preds[model_name] = dict(zip(tiles, model_preds))
+
+    for tile, paths in files_planet.items():
+        if any(tile not in model_preds for model_preds in preds.values()):
+            continue
+
+        with rasterio.open(paths['planet']) as planet_ds:
+            planet = np.transpose(planet_ds.read()[0:3], (1, 2, 0))
+            planet = normalize_image(planet)
+            image_planet = adjust_gamma(planet, 0.8)
+
+        seg_fusion = preds['fusion'][tile].astype(np.uint8)
+        seg_ndvi = preds['ndvi'][tile].astype(np.uint8)
+        seg_rgbn = preds['rgbn'][tile].astype(np.uint8)
 
         edges_fusion = cv2.Canny(seg_fusion, threshold1=0, threshold2=1)
         red_mask_fusion = np.stack((edges_fusion,) * 3, axis=-1)
@@ -140,19 +168,24 @@ def rgb_predictions(preds_fusion:None, preds_ndvi:None, preds_rgbn:None,
         axs[2].set_xticks([])
         axs[2].set_yticks([])
 
-        tile_number = files_planet[idx].split('_')[-2]
-        tile_string = f"tile_{tile_number}_roi{str(roi)}_preds_rgb.png"
+        tile_string = f"{tile}_roi{str(roi)}_preds_rgb.png"
         save_path = os.path.join(SAVE_DIR, tile_string)
         plt.savefig(save_path, facecolor='white', dpi=300, bbox_inches='tight')
         plt.close()
 
-def save_geotiff(pred:np.ndarray, model:str, roi:int, img_dir=IMG_DIR):
+def save_geotiff(pred:np.ndarray, model:str, roi:int, img_dir=IMG_DIR,
+                 compress=None, nbits=None, catalog=None):
 
-    files_planet = sorted(glob.glob(img_dir + '/*planet.tif'))
-    
-    for idx, file in enumerate(files_planet):
-        # Open the reference raster
-        with rasterio.open(file) as ref_raster:
+    with open_catalog(catalog, img_dir) as catalog:
+        tiles = model_tiles(model, img_dir, catalog)
+    if len(tiles) != len(pred):
+        raise ValueError(f"{len(pred)} {model} predictions for {len(tiles)} "
+                         f"tiles in {img_dir}")
+
+    # the predictions follow the tile order of segment_images
+    for (tile, paths), tile_pred in zip(tiles.items(), pred):
+        # Open the chip the prediction was computed from
+        with rasterio.open(paths[MODEL_SENSORS[model][0]]) as ref_raster:
             # Get the metadata from the reference raster
             meta = ref_raster.meta.copy()
 
@@ -163,9 +196,13 @@ def save_geotiff(pred:np.ndarray, model:str, roi:int, img_dir=IMG_DIR):
                 count=1,  # Number of bands in the output GeoTIFF (1 for grayscale)
                 nodata=None  # Set this to a specific value if applicable, otherwise None
             )
-            tile_number = files_planet[idx].split('_')[-2]
-            tile_string = f"tile_{tile_number}_roi{str(roi)}_pred.tif"
+            if nbits is not None:
+                # Binary masks, bit-packed or uint8
+                meta.update(mask_profile(compress, nbits))
+            elif compress is not None:
+                meta.update(compress=compress)
+            tile_string = f"{tile}_roi{str(roi)}_pred.tif"
             output_path = SAVE_DIR + tile_string
             # Save the array as a GeoTIFF file
             with rasterio.open(output_path, 'w', **meta) as dst:
-                dst.write(pred[idx], 1)  # Write the array to the first band of the output GeoTIFF
+                dst.write(tile_pred.astype(meta['dtype']), 1)  # Write the array to the first band of the output GeoTIFF
@@ -1,11 +1,245 @@
 '''Module to extract sampling points for creating the image chips'''
 import geopandas as gpd
+import hashlib
+import math
+import multiprocessing
+import numpy as np
+import pandas as pd
+import shapely
 from shapely.geometry import Polygon
+from src.data.tools.chip_naming import POINT_ID
+from src.data.tools.sampling_cache import SamplingCache
+
+# Number of sampled cells buffered before appending them to the outputs
+WRITE_BATCH = 100000
+
+
+def grid_cells(x0: float, y0: float, rows: range, cols: range,
+               spatial_res: int):
+    """
+    Generate the cells of a sampling grid row by row.
+
+    Parameters:
+    - x0 (float): Left coordinate of the grid origin.
+    - y0 (float): Bottom coordinate of the grid origin.
+    - rows (range): Rows of the grid to generate.
+    - cols (range): Columns of the grid to generate.
+    - spatial_res (int): Spatial resolution in meters.
+
+    Returns:
+    - cells (np.ndarray): The cell polygons.
+    """
+    rows, cols = np.meshgrid(np.asarray(rows), np.asarray(cols),
+                             indexing='ij')
+    return cell_polygons(x0, y0, rows.ravel(), cols.ravel(), spatial_res)
+
+
+def cell_polygons(x0: float, y0: float, rows, cols, spatial_res: int):
+    """
+    Build the polygons of grid cells given by their row and column.
+
+    Parameters:
+    - x0 (float): Left coordinate of the grid origin.
+    - y0 (float): Bottom coordinate of the grid origin.
+    - rows (np.ndarray): Row of every cell.
+    - cols (np.ndarray): Column of every cell.
+    - spatial_res (int): Spatial resolution in meters.
+
+    Returns:
+    - cells (np.ndarray): The cell polygons.
+    """
+    # build the cells as arrays of corner coordinates
+    minx = x0 + np.asarray(cols, dtype=np.int64) * spatial_res
+    maxx = minx + spatial_res
+    miny = y0 + np.asarray(rows, dtype=np.int64) * spatial_res
+    maxy = miny + spatial_res
+    rings = np.stack([np.stack([minx, miny], axis=-1),
+                      np.stack([maxx, miny], axis=-1),
+                      np.stack([maxx, maxy], axis=-1),
+                      np.stack([minx, maxy], axis=-1),
+                      np.stack([minx, miny], axis=-1)], axis=1)
+    return shapely.polygons(rings.reshape(-1, 5, 2))
+
+
+def filter_cells(grid: gpd.GeoDataFrame, ds: gpd.GeoDataFrame,
+                 inter_area: float):
+    """
+    Select the grid cells with an intersection area of at least inter_area
+    with one of the polygons of the dataset.
+
+    Parameters:
+    - grid (gpd.GeoDataFrame): The grid cells.
+    - ds (gpd.GeoDataFrame): The polygons.
+    - inter_area (float): Intersection area in square meters.
+
+    Returns:
+    - cells (GeometryArray): The selected cells, in grid order.
+    """
+    return grid.geometry.values[select_cells(grid, ds, inter_area)]
+
+
+def select_cells(grid: gpd.GeoDataFrame, ds: gpd.GeoDataFrame,
+                 inter_area: float):
+    """
+    Return the positions in the grid of the cells selected by filter_cells,
+    in grid order.
+    """
+    # filter the grid just for the intersections with the ds
+    inter = gpd.sjoin(grid, ds, how='inner', predicate='intersects')
+
+    # the sjoin pairs every cell with the polygons it intersects, so the
+    # intersection areas are only computed for these candidate pairs
+    cells = grid.geometry.values[inter.index.to_numpy()]
+    polygons = ds.geometry.loc[inter['index_right']].values
+    areas = pd.Series(shapely.area(shapely.intersection(cells, polygons)),
+                      index=inter.index)
+
+    # select only the cells that have an intesection area > inter_area
+    # with at least one polygon, in grid order
+    max_area = areas.groupby(level=0).max()
+    return max_area.index[max_area >= inter_area].to_numpy()
+
+
+def _sample_block(args):
+    """
+    Sample the cells of one block of the grid, returning the first row of
+    the block and the rows, columns and polygons of the selected cells.
+    """
+    ds, x0, y0, rows, cols, spatial_res, inter_area = args
+    grid = gpd.GeoDataFrame(geometry=grid_cells(x0, y0, rows, cols,
+                                                spatial_res), crs=ds.crs)
+    selected = select_cells(grid, ds, inter_area)
+    return (rows.start, rows.start + selected // len(cols),
+            cols.start + selected % len(cols),
+            grid.geometry.values[selected])
+
+
+def _iter_blocks(ds, bbox, num_rows, num_cols, spatial_res, block_size,
+                 inter_area):
+    """
+    Partition the grid into blocks of block_size x block_size cells,
+    yielding only the blocks with candidate polygons.
+    """
+    for row in range(0, num_rows, block_size):
+        for col in range(0, num_cols, block_size):
+            rows = range(row, min(row + block_size, num_rows))
+            cols = range(col, min(col + block_size, num_cols))
+            extent = shapely.box(bbox[0] + cols.start * spatial_res,
+                                 bbox[1] + rows.start * spatial_res,
+                                 bbox[0] + cols.stop * spatial_res,
+                                 bbox[1] + rows.stop * spatial_res)
+            candidates = ds.sindex.query(extent)
+            if len(candidates) == 0:
+                continue
+            yield (ds.iloc[np.sort(candidates)][['geometry']], bbox[0],
+                   bbox[1], rows, cols, spatial_res, inter_area)
+
+
+def _write_cells(cells, crs, out_path, save_grid, mode='w',
+                 point_ids=None, first_id=0):
+    final_grid = gpd.GeoDataFrame(geometry=cells, crs=crs)
+
+    # calculates the centroids from the created grids
+    final_grid['centroid'] = final_grid['geometry'].centroid
+
+    # without a cache the points are numbered in grid order
+    if point_ids is None:
+        point_ids = np.arange(first_id, first_id + len(final_grid))
+    gpd.GeoDataFrame({POINT_ID: point_ids},
+                     geometry=final_grid['centroid'],
+                     crs=crs).to_file(out_path + '/points.gpkg', mode=mode)
+
+    if save_grid:
+        final_grid.geometry.to_file(out_path + '/sampling_grid.gpkg',
+                                    mode=mode)
+
+
+def _sample_cached(ds, bbox, spatial_res, epsg, inter_area, out_path,
+                   save_grid, cache_path):
+    """
+    Sample the grid recomputing only the cells whose polygons or
+    parameters changed since the cached run.
+    """
+    cache = SamplingCache(cache_path)
+    reset = []
+    if not cache.matches(spatial_res, epsg):
+        # a new grid, anchored like an uncached run, retiring every point
+        # of the previous one
+        reset = cache.reset_grid(spatial_res, epsg, bbox[0], bbox[1])
+    x0, y0 = cache.origin
+
+    # cells of the cached grid covering the current dataset
+    rows = range(math.floor((bbox[1] - y0) / spatial_res),
+                 math.floor((bbox[3] - y0) / spatial_res) + 1)
+    cols = range(math.floor((bbox[0] - x0) / spatial_res),
+                 math.floor((bbox[2] - x0) / spatial_res) + 1)
+    grid = gpd.GeoDataFrame(geometry=grid_cells(x0, y0, rows, cols,
+                                                spatial_res), crs=ds.crs)
+    inter = gpd.sjoin(grid, ds, how='inner', predicate='intersects')
+
+    # key every cell by the hash of the parameters and of its polygons
+    params = f"{spatial_res}|{epsg}|{inter_area}|"
+    polygon_hash = pd.Series([hashlib.sha1(wkb).hexdigest()
+                              for wkb in ds.geometry.to_wkb()],
+                             index=ds.index)
+    pairs = pd.Series(polygon_hash.loc[inter['index_right']].values,
+                      index=inter.index)
+    cell_hash = pairs.groupby(level=0).agg(
+        lambda h: hashlib.sha1((params + ''.join(sorted(h))).encode())
+        .hexdigest())
+
+    cached = cache.cells()
+    keys = {i: (rows.start + i // len(cols), cols.start + i % len(cols))
+            for i in cell_hash.index}
+    changed = [i for i in cell_hash.index
+               if cached.get(keys[i], (None,))[0] != cell_hash[i]]
+
+    # recompute the intersection areas of the changed cells only
+    sub = inter.loc[changed]
+    areas = pd.Series(shapely.area(shapely.intersection(
+        grid.geometry.values[sub.index.to_numpy()],
+        ds.geometry.loc[sub['index_right']].values)), index=sub.index)
+    keep = areas.groupby(level=0).max() >= inter_area
+
+    added, retired, updates = [], list(reset), []
+    for i in changed:
+        row, col = keys[i]
+        _, was_kept, point_id = cached.get(keys[i], (None, False, None))
+        if keep[i] and point_id is None:
+            point_id = cache.new_id()
+        if keep[i] and not was_kept:
+            added.append(point_id)
+        if was_kept and not keep[i]:
+            retired.append(point_id)
+        updates.append((row, col, cell_hash[i], int(keep[i]), point_id))
+
+    # cells left without any polygon
+    current = set(keys.values())
+    for (row, col), (h, was_kept, point_id) in cached.items():
+        if h is not None and (row, col) not in current:
+            if was_kept:
+                retired.append(point_id)
+            updates.append((row, col, None, 0, point_id))
+
+    cache.update(updates)
+
+    kept = np.array(cache.kept(), dtype=np.int64).reshape(-1, 3)
+    cells = cell_polygons(x0, y0, kept[:, 0], kept[:, 1], spatial_res)
+    _write_cells(cells, ds.crs, out_path, save_grid,
+                 point_ids=kept[:, 2])
+    cache.close()
+
+    summary = {'points': len(kept), 'added': added, 'retired': retired,
+               'recomputed': len(changed),
+               'reused': len(cell_hash) - len(changed)}
+    return summary
 
 
 def create_sampling_points(ds_path: str, spatial_res: int,
                            out_path: str, epsg='EPSG:3857',
-                           inter_area=10000, save_grid=False):
+                           inter_area=10000, save_grid=False,
+                           block_size=None, num_workers=None,
+                           cache_path=None):
     """
     Create sampling points to extract image chips for use in AI frameworks.
 
@@ -16,10 +250,20 @@ def create_sampling_points(ds_path: str, spatial_res: int,
     - epsg (str): Coordinate reference system. Must be metric. Default: EPSG:3857. 
     - inter_area (int): Intersection area in square meters. Default: 10000.
     - save_grid (bool): Flag to save the grid in geopackage format. Default: False.
+    - block_size (int): When set, partition the grid into blocks of block_size x block_size cells that are sampled in a process pool and streamed into the output, so peak memory is bounded by a band of block_size rows of the grid. Blocks without polygons are skipped. The points are the same and in the same grid order as without blocks. Default: None, sample the whole grid at once.
+    - num_workers (int): Number of processes sampling the blocks. Default: None, all cores.
+    - cache_path (str): Path to a SQLite cache of the sampled cells. A rerun only recomputes the cells whose intersecting polygons or parameters changed, and the points keep stable IDs across runs. Cannot be combined with block_size. Default: None.
 
     Returns:
     - centroids (geopackage): Centroids of cells with an
-    intersection area greater than 10000m2, in geopackage format.
+    intersection area greater than 10000m2, in geopackage format, with a
+    point_id column naming their chips (see rasterize_chips and
+    GetImageChips). Without cache_path the points are numbered in grid
+    order.
+    - summary (dict): With cache_path, the number of points, the IDs of the
+    added and retired points and the number of recomputed and reused cells.
+    When spatial_res or epsg change, every point of the previous grid is
+    retired.
 
     Example Usage:
     create_sampling_points(ds_path='user/Downloads', spatial_res=2000,
@@ -48,45 +292,52 @@ def create_sampling_points(ds_path: str, spatial_res: int,
     num_rows = int((bbox[3] - bbox[1]) / spatial_res) + 1
     num_cols = int((bbox[2] - bbox[0]) / spatial_res) + 1
 
-    # generate the grid cells
-    grid_cells = []
-    for row in range(num_rows):
-        for col in range(num_cols):
-            minx = bbox[0] + col * spatial_res
-            maxx = minx + spatial_res
-            miny = bbox[1] + row * spatial_res
-            maxy = miny + spatial_res
-            polygon = Polygon([(minx, miny), (maxx, miny),
-                               (maxx, maxy), (minx, maxy)])
-            grid_cells.append(polygon)
-
-    grid = gpd.GeoDataFrame(geometry=grid_cells, crs=roi.crs)
-
-    # filter the grid just for the intersections with the ds
-    inter = gpd.sjoin(grid, ds, how='inner', op='intersects')
-
-    # check if there are duplicates
-    duplicates = inter.duplicated(subset='geometry')
+    if cache_path is not None:
+        if block_size is not None:
+            raise ValueError('cache_path cannot be combined with block_size')
+        return _sample_cached(ds, bbox, spatial_res, epsg, inter_area,
+                              out_path, save_grid, cache_path)
 
-    deduplicated = inter[~duplicates].reset_index(drop=True)
+    if block_size is not None:
+        blocks = _iter_blocks(ds, bbox, num_rows, num_cols, spatial_res,
+                              block_size, inter_area)
+        mode = 'w'
+        buffer, written = [], 0
+        band, band_start = [], None
 
-    # Create an empty GeoDataFrame to store the filtered polygons
-    polygons_to_keep = []
+        def flush_band():
+            # the blocks of a band of rows are sorted back into grid order
+            if band:
+                rows, cols, cells = (np.concatenate(a) for a in zip(*band))
+                buffer.extend(cells[np.lexsort((cols, rows))])
+                band.clear()
 
-    # select only the polygons that have an intesection area > inter_area
-    for idx, row in deduplicated.iterrows():
-        geometry = row['geometry']
-        intersection_area = ds.intersection(geometry).area
-        if intersection_area.max() >= inter_area:
-            polygons_to_keep.append(geometry)
+        with multiprocessing.Pool(num_workers) as pool:
+            for start, rows, cols, cells in pool.imap(_sample_block, blocks):
+                if start != band_start:
+                    flush_band()
+                    band_start = start
+                band.append((rows, cols, cells))
+                # append to the outputs in batches, as gpkg writes are slow
+                if len(buffer) >= WRITE_BATCH:
+                    _write_cells(buffer, roi.crs, out_path, save_grid, mode,
+                                 first_id=written)
+                    written += len(buffer)
+                    buffer, mode = [], 'a'
+        flush_band()
 
-    final_grid = gpd.GeoDataFrame(geometry=polygons_to_keep,
-                                  crs=roi.crs)
+        if len(buffer) > 0 or mode == 'w':
+            _write_cells(buffer, roi.crs, out_path, save_grid, mode,
+                         first_id=written)
+        return
 
-    # calculates the centroids from the created grids
-    final_grid['centroid'] = final_grid['geometry'].centroid
+    # generate the grid cells
+    grid = gpd.GeoDataFrame(geometry=grid_cells(bbox[0], bbox[1],
+                                                range(num_rows),
+                                                range(num_cols),
+                                                spatial_res),
+                            crs=roi.crs)
 
-    final_grid.centroid.to_file(out_path + '/points.gpkg')
+    polygons_to_keep = filter_cells(grid, ds, inter_area)
 
-    if save_grid:
-        final_grid.geometry.to_file(out_path + '/sampling_grid.gpkg')
+    _write_cells(polygons_to_keep, roi.crs, out_path, save_grid)
@@ -0,0 +1,93 @@
+'''Module to cache the sampling results of the grid cells between runs'''
+
+import sqlite3
+
+
+class SamplingCache:
+    """
+    SQLite cache of the sampled grid cells, keyed by their row and column.
+
+    Each cell stores the hash of the polygons intersecting it and of the
+    sampling parameters, whether it was kept, and the stable ID of its
+    sampling point. The grid origin is stored too, so later runs keep the
+    same cells even when the extent of the dataset changes.
+
+    Parameters:
+    - path (str): The file path of the cache.
+
+    Example Usage:
+    cache = SamplingCache('data/sampling_cache.sqlite')
+    cache.reset_grid(2000, 'EPSG:3857', x0, y0)
+    """
+    def __init__(self, path: str):
+        self.con = sqlite3.connect(path)
+        self.con.execute('CREATE TABLE IF NOT EXISTS meta '
+                         '(key TEXT PRIMARY KEY, value TEXT)')
+        self.con.execute('CREATE TABLE IF NOT EXISTS cells '
+                         '(row INTEGER, col INTEGER, hash TEXT, '
+                         'keep INTEGER, point_id INTEGER, '
+                         'PRIMARY KEY (row, col))')
+        self.meta = dict(self.con.execute('SELECT key, value FROM meta'))
+
+    def matches(self, spatial_res: int, epsg: str):
+        """
+        Check whether the cached cells were sampled on the same grid.
+        """
+        return (self.meta.get('spatial_res') == str(spatial_res)
+                and self.meta.get('epsg') == str(epsg))
+
+    def reset_grid(self, spatial_res: int, epsg: str, x0: float, y0: float):
+        """
+        Drop the cached cells and anchor a new grid at (x0, y0). Point IDs
+        keep increasing so they are never reused.
+
+        Returns:
+        - retired (list): The IDs of the points of the dropped grid.
+        """
+        retired = [point_id for _, _, point_id in self.kept()]
+        self.con.execute('DELETE FROM cells')
+        self.meta.update({'spatial_res': str(spatial_res),
+                          'epsg': str(epsg),
+                          'x0': repr(x0), 'y0': repr(y0),
+                          'next_id': self.meta.get('next_id', '0')})
+        return retired
+
+    @property
+    def origin(self):
+        return float(self.meta['x0']), float(self.meta['y0'])
+
+    def cells(self):
+        """
+        Return the cached cells as {(row, col): (hash, keep, point_id)}.
+        """
+        query = 'SELECT row, col, hash, keep, point_id FROM cells'
+        return {(row, col): (h, bool(keep), point_id)
+                for row, col, h, keep, point_id in self.con.execute(query)}
+
+    def new_id(self):
+        point_id = int(self.meta['next_id'])
+        self.meta['next_id'] = str(point_id + 1)
+        return point_id
+
+    def update(self, cells):
+        """
+        Store (row, col, hash, keep, point_id) records and commit them
+        together with the grid metadata.
+        """
+        self.con.executemany('INSERT OR REPLACE INTO cells '
+                             'VALUES (?, ?, ?, ?, ?)', cells)
+        self.con.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                             self.meta.items())
+        self.con.commit()
+
+    def kept(self):
+        """
+        Return the rows, columns and point IDs of the kept cells, ordered
+        by point ID.
+        """
+        return self.con.execute('SELECT row, col, point_id FROM cells '
+                                'WHERE keep = 1 '
+                                'ORDER BY point_id').fetchall()
+
+    def close(self):
+        self.con.close()
@@ -0,0 +1,197 @@
+'''Module to write the chips into shard files and stream them for training'''
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import numpy as np
+import os
+import random
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+INDEX_NAME = 'index.json'
+SHARD_SIZE = 64
+
+
+def shard_filename(number: int):
+    return f'shard_{number:05d}.npz'
+
+
+def write_shards(arrays: dict, out_dir: str, shard_size=SHARD_SIZE,
+                 tiles=None):
+    """
+    Group the chips of every sensor and the masks into shard files of
+    shard_size tiles each, plus an index.json describing them. Every shard is
+    an uncompressed .npz holding one stacked array per name, so a whole shard
+    is read with one sequential pass instead of one GeoTIFF open per chip.
+
+    Parameters:
+    - arrays (dict): {name: (paths, read)}, where read(path) returns the normalized array of a chip in its final layout.
+    - out_dir (str): The directory of the shards.
+    - shard_size (int): The number of tiles per shard. Default: 64.
+    - tiles (list): The tile IDs of the samples, kept in the index. Default: None.
+
+    Returns:
+    - index (dict): The content of index.json.
+
+    Example Usage:
+    write_shards({'image': (img_files, read_image), 'mask': (mask_files, read_mask)}, 'data/shards/train')
+    """ # noqa
+    os.makedirs(out_dir, exist_ok=True)
+    lengths = {len(paths) for paths, _ in arrays.values()}
+    if len(lengths) != 1:
+        raise ValueError(f"the arrays have different lengths: {lengths}")
+    length = lengths.pop()
+
+    index = {'length': length, 'shards': [], 'arrays': {}}
+    for number, start in enumerate(range(0, length, shard_size)):
+        stop = min(start + shard_size, length)
+        shard = {}
+        for name, (paths, read) in arrays.items():
+            first = read(paths[start])
+            stacked = np.empty((stop - start,) + first.shape, first.dtype)
+            stacked[0] = first
+            for i, path in enumerate(paths[start + 1:stop], start=1):
+                stacked[i] = read(path)
+            shard[name] = stacked
+            index['arrays'][name] = {'dtype': str(first.dtype),
+                                     'shape': list(first.shape)}
+
+        filename = shard_filename(number)
+        np.savez(os.path.join(out_dir, filename), **shard)
+        index['shards'].append({
+            'file': filename,
+            'length': stop - start,
+            'tiles': None if tiles is None else tiles[start:stop],
+        })
+
+    with open(os.path.join(out_dir, INDEX_NAME), 'w') as f:
+        json.dump(index, f)
+
+    return index
+
+
+class ShardedDataset(IterableDataset):
+    """
+    Stream the samples of the shards written by write_shards. The shards are
+    split across the nodes of a torch.distributed run and the DataLoader
+    workers of every node, so each shard is read once per epoch. While a
+    shard is consumed the next one is read by a background thread, and the
+    samples pass through a shuffle buffer.
+
+    The shard order is shuffled with seed + epoch, so it is the same on
+    every node. Call set_epoch at the start of every epoch to draw a new
+    order, as with DistributedSampler. The number of shards should be a
+    multiple of the number of nodes times workers for all of them to get
+    the same amount of samples.
+
+    Parameters:
+    - path (str): The directory of the shards.
+    - shuffle (bool): Shuffle the shards and the samples. Default: True.
+    - buffer_size (int): The number of samples in the shuffle buffer. Default: 256.
+    - seed (int): The seed of the shard order and shuffle buffers. Default: 42.
+    - copies (int): The number of samples yielded per tile, e.g. 2 for the original and an augmented copy. Default: 1.
+    - sample_fn (callable): sample_fn(sample, copy) turns the dict of tensors of a tile into the sample yielded for that copy. Default: None, the dict itself.
+    - rank (int): The rank of this node. Default: None, from torch.distributed.
+    - world_size (int): The number of nodes. Default: None, from torch.distributed.
+
+    Example Usage:
+    dataset = ShardedDataset('data/shards/train', buffer_size=512)
+    loader = DataLoader(dataset, batch_size=16, num_workers=4)
+    for epoch in range(NUM_EPOCHS):
+        dataset.set_epoch(epoch)
+        for sample in loader:
+            ...
+    """ # noqa
+    def __init__(self, path: str, shuffle=True, buffer_size=256, seed=42,
+                 copies=1, sample_fn=None, rank=None, world_size=None):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME)) as f:
+            self.index = json.load(f)
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.copies = copies
+        self.sample_fn = sample_fn
+        self.epoch = 0
+
+        distributed = (torch.distributed.is_available() and
+                       torch.distributed.is_initialized())
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        if world_size is None:
+            world_size = (torch.distributed.get_world_size() if distributed
+                          else 1)
+        self.rank = rank
+        self.world_size = world_size
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def node_shards(self):
+        """
+        Return the shards of this node for the current epoch.
+        """
+        shards = list(self.index['shards'])
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        return shards[self.rank::self.world_size]
+
+    def __len__(self):
+        # samples yielded on this node, over all of its workers
+        tiles = sum(shard['length'] for shard in self.node_shards())
+        return tiles * self.copies
+
+    def load_shard(self, shard: dict):
+        with np.load(os.path.join(self.path, shard['file'])) as data:
+            return {name: data[name] for name in self.index['arrays']}
+
+    def iter_tiles(self, shards):
+        """
+        Yield the dict of tensors of every tile, reading the next shard in
+        the background.
+        """
+        if not shards:
+            return
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(self.load_shard, shards[0])
+            for following in shards[1:] + [None]:
+                arrays = future.result()
+                if following is not None:
+                    future = executor.submit(self.load_shard, following)
+                length = len(next(iter(arrays.values())))
+                for i in range(length):
+                    yield {name: torch.from_numpy(array[i])
+                           for name, array in arrays.items()}
+
+    def __iter__(self):
+        worker = get_worker_info()
+        if worker is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker.id, worker.num_workers
+        shards = self.node_shards()[worker_id::num_workers]
+
+        rng = random.Random(f'{self.seed}-{self.epoch}-{self.rank}-'
+                            f'{worker_id}')
+        buffer = []
+        for tile in self.iter_tiles(shards):
+            for copy in range(self.copies):
+                if not self.shuffle:
+                    yield self.prepare(tile, copy)
+                    continue
+                # swap a random sample of the full buffer out for this one
+                if len(buffer) < self.buffer_size:
+                    buffer.append((tile, copy))
+                    continue
+                i = rng.randrange(len(buffer))
+                buffer[i], (tile_out, copy_out) = (tile, copy), buffer[i]
+                yield self.prepare(tile_out, copy_out)
+
+        rng.shuffle(buffer)
+        for tile, copy in buffer:
+            yield self.prepare(tile, copy)
+
+    def prepare(self, tile: dict, copy: int):
+        if self.sample_fn is None:
+            return tile
+        return self.sample_fn(tile, copy)
@@ -0,0 +1,47 @@
+'''Module to hold the loaded chips in one shared-memory tensor per array'''
+
+import torch
+
+
+class SharedStack:
+    """
+    Stack of same-shape tensors preallocated as one contiguous tensor in
+    shared memory, filled one sample at a time. The DataLoader workers index
+    the same block instead of a list of tensors, so their refcount updates
+    do not copy the chips on write and memory stays flat as the number of
+    workers grows. With the spawn start method the block is passed to the
+    workers by handle rather than copied.
+
+    Parameters:
+    - length (int): The number of samples.
+
+    Example Usage:
+    images = SharedStack(len(files))
+    for path in files:
+        images.append(read_tensor(path))
+    images = images.tensor
+    """
+    def __init__(self, length: int):
+        self.length = length
+        self.count = 0
+        self.shared = None
+
+    def append(self, tensor):
+        if self.shared is None:
+            self.shared = torch.empty((self.length, *tensor.shape),
+                                      dtype=tensor.dtype).share_memory_()
+        elif tensor.shape != self.shared.shape[1:]:
+            raise ValueError(f"sample {self.count} has shape "
+                             f"{tuple(tensor.shape)}, expected "
+                             f"{tuple(self.shared.shape[1:])}")
+        self.shared[self.count] = tensor
+        self.count += 1
+
+    @property
+    def tensor(self):
+        """
+        The samples appended so far, as a view of the shared block.
+        """
+        if self.shared is None:
+            return torch.empty(0)
+        return self.shared[:self.count]
@@ -0,0 +1,113 @@
+'''Module to summarize the telemetry of a chip download run'''
+
+import collections
+import csv
+import json
+import numpy as np
+import os
+
+RECORD_FIELDS = ['file', 'status', 'bytes', 'latency', 'retries',
+                 'started', 'finished', 'error', 'region', 'cog_seconds']
+
+
+def summarize(records, bucket=60, slowest=20):
+    """
+    Summarize the per-chip records of a download run.
+
+    Parameters:
+    - records (list): The manifest records of the run, with their telemetry.
+    - bucket (int): Width in seconds of the throughput time buckets. Default: 60.
+    - slowest (int): Number of slowest chips to report. Default: 20.
+
+    Returns:
+    - summary (dict): Chip counts, failure reasons, latency percentiles,
+    retries, overall throughput, throughput over time and the slowest chips.
+
+    Example Usage:
+    summary = summarize(records, bucket=30)
+    """ # noqa
+    records = [r for r in records if 'latency' in r]
+    if len(records) == 0:
+        return {'chips': 0}
+
+    complete = [r for r in records if r['status'] == 'complete']
+    latency = np.array([r['latency'] for r in complete])
+    retries = np.array([r['retries'] for r in records])
+    start = min(r['started'] for r in records)
+    end = max(r['finished'] for r in records)
+    duration = max(end - start, 1e-9)
+    nbytes = sum(r['bytes'] for r in complete)
+
+    # Chips and bytes finished in every time bucket since the start
+    timeline = collections.defaultdict(lambda: [0, 0])
+    for r in complete:
+        key = int((r['finished'] - start) // bucket)
+        timeline[key][0] += 1
+        timeline[key][1] += r['bytes']
+
+    summary = {
+        'chips': len(records),
+        'complete': len(complete),
+        'failed': len(records) - len(complete),
+        'failure_reasons': dict(collections.Counter(
+            r.get('error') for r in records if r['status'] != 'complete')),
+        'duration_s': duration,
+        'bytes': nbytes,
+        'chips_per_s': len(complete) / duration,
+        'mb_per_s': nbytes / duration / 1e6,
+        'retries': int(retries.sum()),
+        'chips_retried': int((retries > 0).sum()),
+        'latency_s': {},
+        'throughput': [{'start_s': key * bucket,
+                        'chips_per_s': chips / bucket,
+                        'mb_per_s': size / bucket / 1e6}
+                       for key, (chips, size) in sorted(timeline.items())],
+        'slowest': [{'file': r['file'], 'latency_s': r['latency'],
+                     'bytes': r['bytes'], 'retries': r['retries']}
+                    for r in sorted(complete, key=lambda r: r['latency'],
+                                    reverse=True)[:slowest]],
+    }
+
+    if len(latency) > 0:
+        summary['latency_s'] = {
+            'mean': float(latency.mean()),
+            'p50': float(np.percentile(latency, 50)),
+            'p90': float(np.percentile(latency, 90)),
+            'p95': float(np.percentile(latency, 95)),
+            'p99': float(np.percentile(latency, 99)),
+            'max': float(latency.max()),
+        }
+
+    return summary
+
+
+def write_report(records, out_dir: str, name='download_report', **kwargs):
+    """
+    Write the telemetry of a download run as a JSON summary and a CSV file
+    with one row per chip.
+
+    Parameters:
+    - records (list): The manifest records of the run, with their telemetry.
+    - out_dir (str): The directory to save the report.
+    - name (str): The base name of the report files. Default: 'download_report'.
+    - **kwargs: Options passed to summarize.
+
+    Returns:
+    - summary (dict): The summary written to <name>.json.
+
+    Example Usage:
+    write_report(records, 'data/gee_data', name='download_report_s1')
+    """ # noqa
+    summary = summarize(records, **kwargs)
+    out_dir = os.path.abspath(out_dir)
+
+    with open(os.path.join(out_dir, name + '.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    with open(os.path.join(out_dir, name + '.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS,
+                                extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(records)
+
+    return summary
@@ -1,9 +1,9 @@
 """Module for train-test split for AI model training."""
 
 import random
-import glob
 import os
 import shutil
+from src.data.tools.catalog import open_catalog, tile_index
 
 CROPED_DATA_DIR = '../../../data/croped_data/'
 TRAIN_IMG_DIR = '../../../data/ai_data/train_images'
@@ -18,7 +18,8 @@ def train_test_split(train_frac: float,
                      Planet: bool,
                      S1: bool,
                      NDVI: bool,
-                     Palsar: bool):
+                     Palsar: bool,
+                     catalog=None):
     """
     Split the dataset into train and validation sets based on the given
     fractions and data sources.
@@ -30,6 +31,7 @@ def train_test_split(train_frac: float,
     - S1 (bool): Flag indicating whether to include Sentinel-1 data.
     - NDVI (bool): Flag indicating whether to include NDVI data.
     - Palsar (bool): Flag indicating whether to include PALSAR data.
+    - catalog (str): The tile catalog used to look up the rasters of every tile, where the split of every tile is recorded. Default: None.
 
     Example Usage:
     train_test_split(train_frac=0.8, Planet=True, S1=True, NDVI=True, Palsar=True)
@@ -37,51 +39,46 @@ def train_test_split(train_frac: float,
 
     current_dir = os.getcwd()
     module_dir = os.path.dirname(os.path.abspath(__file__))
-    os.chdir(module_dir)
-
-    # Get a list of all reference raster files
-    files = sorted(glob.glob(CROPED_DATA_DIR + '*ref.tif'))
-
-    # Split the files into train and validation sets
-    mask_val = sorted(random.sample(files, int(len(files) * train_frac)))
-    mask_train = sorted([file for file in files if file not in mask_val])
-
-    # Generate file paths for each data source and set
-    planet_val = [file.replace('ref.tif', 'planet.tif') for file in mask_val]
-    planet_train = [file.replace('ref.tif',
-                                 'planet.tif') for file in mask_train]
-
-    s1_val = [file.replace('ref.tif', 's1.tif') for file in mask_val]
-    s1_train = [file.replace('ref.tif',
-                             's1.tif') for file in mask_train]
-
-    NDVI_val = [file.replace('ref.tif', 'ndvi.tif') for file in mask_val]
-    NDVI_train = [file.replace('ref.tif',
-                               'ndvi.tif') for file in mask_train]
-
-    palsar_val = [file.replace('ref.tif', 'palsar.tif') for file in mask_val]
-    palsar_train = [file.replace('ref.tif',
-                                 'palsar.tif') for file in mask_train]
-
-    # Concatenate the data sources based on the provided flags
-    train_images = (planet_train * Planet) + \
-                   (s1_train * S1) + (NDVI_train * NDVI) + \
-                   (palsar_train * Palsar)
-
-    val_images = (planet_val * Planet) + \
-                 (s1_val * S1) + (NDVI_val * NDVI) + (palsar_val * Palsar)
-
-    # Copy the images to the appropriate directories
-    for image in train_images:
-        shutil.copy(image, TRAIN_IMG_DIR)
-
-    for image in mask_train:
-        shutil.copy(image, TRAIN_MASK_DIR)
-
-    for image in val_images:
-        shutil.copy(image, VAL_IMG_DIR)
-
-    for image in mask_val:
-        shutil.copy(image, VAL_MASK_DIR)
-
-    os.chdir(current_dir)
+    with open_catalog(catalog,
+                      os.path.join(module_dir, CROPED_DATA_DIR)) as catalog:
+        os.chdir(module_dir)
+        try:
+            _split_files(train_frac, Planet, S1, NDVI, Palsar, catalog)
+        finally:
+            os.chdir(current_dir)
+
+
+def _split_files(train_frac, Planet, S1, NDVI, Palsar, catalog):
+    # Look up the reference and the selected sensors of every tile by tile ID
+    sensors = [sensor for sensor, selected in (('planet', Planet), ('s1', S1),
+                                               ('ndvi', NDVI),
+                                               ('palsar', Palsar))
+               if selected]
+    tiles = tile_index({sensor: CROPED_DATA_DIR
+                        for sensor in ['ref'] + sensors}, catalog,
+                       complete=False)
+    tiles = {tile: paths for tile, paths in tiles.items() if 'ref' in paths}
+    for tile, paths in tiles.items():
+        missing = [sensor for sensor in sensors if sensor not in paths]
+        if missing:
+            raise ValueError(f"{tile} has no {', '.join(missing)} raster in "
+                             f"{CROPED_DATA_DIR}")
+
+    # Split the tiles into train and validation sets
+    tiles_val = sorted(random.sample(list(tiles),
+                                     int(len(tiles) * train_frac)))
+    tiles_train = [tile for tile in tiles if tile not in tiles_val]
+
+    # Copy the images and masks of every tile to the appropriate directories
+    for split, split_tiles, img_dir, mask_dir in (
+            ('train', tiles_train, TRAIN_IMG_DIR, TRAIN_MASK_DIR),
+            ('val', tiles_val, VAL_IMG_DIR, VAL_MASK_DIR)):
+        for sensor in sensors:
+            for tile in split_tiles:
+                shutil.copy(tiles[tile][sensor], img_dir)
+
+        for tile in split_tiles:
+            shutil.copy(tiles[tile]['ref'], mask_dir)
+
+        if catalog is not None:
+            catalog.set_split(split_tiles, split)
@@ -0,0 +1,94 @@
+'''Module to reference windows of rasters as lightweight VRT files'''
+
+import os
+import numpy as np
+import rasterio
+from xml.sax.saxutils import escape
+
+# GDAL names of the numpy data types
+GDAL_TYPES = {
+    'int8': 'Int8',
+    'uint8': 'Byte',
+    'int16': 'Int16',
+    'uint16': 'UInt16',
+    'int32': 'Int32',
+    'uint32': 'UInt32',
+    'float32': 'Float32',
+    'float64': 'Float64',
+}
+
+
+def vrt_filename(filename: str):
+    """
+    Return the VRT file path matching a raster file path.
+    """
+    return os.path.splitext(filename)[0] + '.vrt'
+
+
+def write_window_vrt(src_path: str, window, out_path: str):
+    """
+    Write a VRT referencing a window of a raster instead of copying its
+    pixels. The source is referenced by absolute path, so the VRT can be
+    copied or moved around as long as the source stays in place.
+
+    Parameters:
+    - src_path (str): The file path of the source raster.
+    - window (rasterio.windows.Window): The window of the source to reference. Fractional windows are sampled like a windowed read.
+    - out_path (str): The file path of the VRT.
+
+    Returns:
+    - bounds (tuple): The (minx, miny, maxx, maxy) bounds of the VRT.
+
+    Example Usage:
+    write_window_vrt('gee_data/tile_0001_s1.tif', Window(10, 10, 200, 200), 'croped_data/tile_0001_s1.vrt')
+    """ # noqa
+    src_path = os.path.abspath(src_path)
+
+    with rasterio.open(src_path) as src:
+        transform = src.window_transform(window)
+        bounds = rasterio.windows.bounds(window, src.transform)
+        crs = src.crs.to_wkt() if src.crs else None
+        dtypes = src.dtypes
+        nodata = src.nodata
+        block_y, block_x = src.block_shapes[0]
+        width, height = src.width, src.height
+
+    width_out, height_out = round(window.width), round(window.height)
+    lines = [f'<VRTDataset rasterXSize="{width_out}" '
+             f'rasterYSize="{height_out}">']
+    if crs is not None:
+        lines.append(f'  <SRS dataAxisToSRSAxisMapping="1,2">'
+                     f'{escape(crs)}</SRS>')
+    lines.append('  <GeoTransform>' +
+                 ', '.join(repr(float(v)) for v in transform.to_gdal()) +
+                 '</GeoTransform>')
+
+    for band, dtype in enumerate(dtypes, start=1):
+        lines.append(f'  <VRTRasterBand dataType="{GDAL_TYPES[dtype]}" '
+                     f'band="{band}">')
+        if nodata is not None:
+            value = 'nan' if np.isnan(nodata) else repr(nodata)
+            lines.append(f'    <NoDataValue>{value}</NoDataValue>')
+        lines += [
+            '    <SimpleSource>',
+            f'      <SourceFilename relativeToVRT="0">{escape(src_path)}'
+            '</SourceFilename>',
+            f'      <SourceBand>{band}</SourceBand>',
+            f'      <SourceProperties RasterXSize="{width}" '
+            f'RasterYSize="{height}" DataType="{GDAL_TYPES[dtype]}" '
+            f'BlockXSize="{block_x}" BlockYSize="{block_y}" />',
+            f'      <SrcRect xOff="{float(window.col_off)!r}" '
+            f'yOff="{float(window.row_off)!r}" '
+            f'xSize="{float(window.width)!r}" '
+            f'ySize="{float(window.height)!r}" />',
+            f'      <DstRect xOff="0" yOff="0" xSize="{width_out}" '
+            f'ySize="{height_out}" />',
+            '    </SimpleSource>',
+            '  </VRTRasterBand>',
+        ]
+    lines.append('</VRTDataset>')
+
+    with open(out_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    return bounds
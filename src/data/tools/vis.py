@@ -4,9 +4,9 @@ import rasterio
 import numpy as np
 import matplotlib.pyplot as plt
 from skimage.exposure import adjust_gamma
-import glob
 import os
 import cv2
+from src.data.tools.catalog import open_catalog, tile_index
 
 
 plt.rcParams['figure.dpi'] = 300
@@ -22,13 +22,46 @@ def normalize_image(image):
     return image
 
 
-def reference_image(tile_number: int, save_fig: bool):
+def tile_files(imgs_dir: str, tile_number, sensors: list, catalog=None):
+    '''
+    Look up the rasters of the sensors of one tile by its tile ID.
+
+    Parameters:
+    - imgs_dir (str): The directory of the rasters.
+    - tile_number (int or str): Index of the tile among the tiles of the first sensor, or its tile ID.
+    - sensors (list): The sensors to look up, e.g. ['planet', 'ref'].
+    - catalog (str): The tile catalog used to look up the tile. Default: None.
+
+    Returns:
+    - tile (str): The tile ID.
+    - files (dict): {sensor: path} of the tile.
+    ''' # noqa
+    with open_catalog(catalog, imgs_dir) as catalog:
+        tiles = tile_index({sensor: imgs_dir for sensor in sensors}, catalog,
+                           complete=False)
+
+    if isinstance(tile_number, str):
+        tile = tile_number
+    else:
+        tile = [tile for tile, paths in tiles.items()
+                if sensors[0] in paths][tile_number]
+
+    files = tiles.get(tile, {})
+    missing = [sensor for sensor in sensors if sensor not in files]
+    if missing:
+        raise ValueError(f"{tile} has no {', '.join(missing)} raster in "
+                         f"{imgs_dir}")
+    return tile, files
+
+
+def reference_image(tile_number, save_fig: bool, catalog=None):
     '''
     Visualizes a reference imagery tile.
 
     Parameters:
-    - tile_number (int): Index of the tile to visualize.
+    - tile_number (int or str): Index or tile ID of the tile to visualize.
     - save_fig (bool): Flag to save the visualization as a PNG image.
+    - catalog (str): The tile catalog used to look up the tile. Default: None.
 
     Example Usage:
     reference_image(tile_number=0, save_fig=True)
@@ -41,11 +74,11 @@ def reference_image(tile_number: int, save_fig: bool):
     '''
     module_dir = os.path.dirname(os.path.abspath(__file__))
     imgs_dir = os.path.join(module_dir, '../../../data/croped_data/')
-    files_ref = sorted(glob.glob(os.path.join(imgs_dir, '*ref.tif')))
-    tile_str = os.path.splitext(os.path.basename(files_ref[tile_number]))[0]
+    _, files = tile_files(imgs_dir, tile_number, ['ref'], catalog)
+    tile_str = os.path.splitext(os.path.basename(files['ref']))[0]
     save_dir = os.path.join(module_dir, '../../../data/figures/')
 
-    with rasterio.open(files_ref[tile_number]) as reference:
+    with rasterio.open(files['ref']) as reference:
         ref = reference.read(1).astype(np.uint8)
         plt.imshow(ref, vmin=0, vmax=1, cmap='gray')
         plt.yticks([])
@@ -58,15 +91,17 @@ def reference_image(tile_number: int, save_fig: bool):
         plt.title(tile_str)
 
 
-def planet_image(tile_number: int, save_fig: bool, draw_ref=False):
+def planet_image(tile_number, save_fig: bool, draw_ref=False,
+                 catalog=None):
     '''
     Visualizes a Planet RGB imagery tile.
     RGB median composite from year 2020.
 
     Parameters:
-    - tile_number (int): Index of the tile to visualize.
+    - tile_number (int or str): Index or tile ID of the tile to visualize.
     - draw_ref (bool): Flag to draw reference borders on the image.
     - save_fig (bool): Flag to save the visualization as a PNG image.
+    - catalog (str): The tile catalog used to look up the tile. Default: None.
 
     Example Usage:
     planet_image(tile_number=0, draw_ref=True, save_fig=True)
@@ -80,12 +115,12 @@ def planet_image(tile_number: int, save_fig: bool, draw_ref=False):
 
     module_dir = os.path.dirname(os.path.abspath(__file__))
     imgs_dir = os.path.join(module_dir, '../../../data/croped_data/')
-    files_planet = sorted(glob.glob(os.path.join(imgs_dir, '*planet.tif')))
-    files_ref = sorted(glob.glob(os.path.join(imgs_dir, '*ref.tif')))
-    tile_str = os.path.splitext(os.path.basename(files_planet[tile_number]))[0]
+    _, files = tile_files(imgs_dir, tile_number,
+                          ['planet'] + ['ref'] * draw_ref, catalog)
+    tile_str = os.path.splitext(os.path.basename(files['planet']))[0]
     save_dir = os.path.join(module_dir, '../../../data/figures/')
 
-    with rasterio.open(files_planet[tile_number]) as planet_ds:
+    with rasterio.open(files['planet']) as planet_ds:
 
         planet = np.transpose(planet_ds.read()[0:3], (1, 2, 0))
         planet = normalize_image(planet)
@@ -93,7 +128,7 @@ def planet_image(tile_number: int, save_fig: bool, draw_ref=False):
         
 
         if draw_ref:
-            with rasterio.open(files_ref[tile_number]) as reference:
+            with rasterio.open(files['ref']) as reference:
                 ref = reference.read(1).astype(np.uint8)
                 edges = cv2.Canny(ref, threshold1=0, threshold2=1)
                 red_mask = np.stack((edges,) * 3, axis=-1)
@@ -110,15 +145,17 @@ def planet_image(tile_number: int, save_fig: bool, draw_ref=False):
         plt.title(tile_str)
 
 
-def ndvi_image(tile_number: int, save_fig: bool, draw_ref=False):
+def ndvi_image(tile_number, save_fig: bool, draw_ref=False,
+               catalog=None):
     '''
     Visualizes a Planet NDVI imagery tile.
     Red:NDVI 2016. Green:NDVI 2018. Blue: NDVI 2020.
 
     Parameters:
-    - tile_number (int): Index of the tile to visualize.
+    - tile_number (int or str): Index or tile ID of the tile to visualize.
     - draw_ref (bool): Flag to draw reference borders on the image.
     - save_fig (bool): Flag to save the visualization as a PNG image.
+    - catalog (str): The tile catalog used to look up the tile. Default: None.
 
     Example Usage:
     ndvi_image(tile_number=0, draw_ref=True, save_fig=True)
@@ -132,19 +169,19 @@ def ndvi_image(tile_number: int, save_fig: bool, draw_ref=False):
 
     module_dir = os.path.dirname(os.path.abspath(__file__))
     imgs_dir = os.path.join(module_dir, '../../../data/croped_data/')
-    files_ndvi = sorted(glob.glob(os.path.join(imgs_dir, '*ndvi.tif')))
-    files_ref = sorted(glob.glob(os.path.join(imgs_dir, '*ref.tif')))
-    tile_str = os.path.splitext(os.path.basename(files_ndvi[tile_number]))[0]
+    _, files = tile_files(imgs_dir, tile_number,
+                          ['ndvi'] + ['ref'] * draw_ref, catalog)
+    tile_str = os.path.splitext(os.path.basename(files['ndvi']))[0]
     save_dir = os.path.join(module_dir, '../../../data/figures/')
 
-    with rasterio.open(files_ndvi[tile_number]) as ndvi_ds:
+    with rasterio.open(files['ndvi']) as ndvi_ds:
          
         ndvi = np.transpose(ndvi_ds.read(), (1, 2, 0))
         ndvi = np.clip(((ndvi + 1) / 2), 0.75, 1)
         ndvi = adjust_gamma(ndvi, 7)
 
         if draw_ref:
-            with rasterio.open(files_ref[tile_number]) as reference:
+            with rasterio.open(files['ref']) as reference:
                 ref = reference.read(1).astype(np.uint8)
                 edges = cv2.Canny(ref, threshold1=0, threshold2=1)
                 red_mask = np.stack((edges,) * 3, axis=-1)
@@ -161,15 +198,17 @@ def ndvi_image(tile_number: int, save_fig: bool, draw_ref=False):
         plt.title(tile_str)
 
 
-def s1_image(tile_number: int, save_fig: bool, draw_ref=False):
+def s1_image(tile_number, save_fig: bool, draw_ref=False,
+             catalog=None):
     '''
     Visualizes a Sentinel-1 Band C VH imagery tile.
     Red: VH 2016. Green: VH 2018. Blue: VH 2020.
 
     Parameters:
-    - tile_number (int): Index of the tile to visualize.
+    - tile_number (int or str): Index or tile ID of the tile to visualize.
     - draw_ref (bool): Flag to draw reference borders on the image.
     - save_fig (bool): Flag to save the visualization as a PNG image.
+    - catalog (str): The tile catalog used to look up the tile. Default: None.
 
     Example Usage:
     s1_image(tile_number=0, draw_ref=True, save_fig=True)
@@ -183,19 +222,19 @@ def s1_image(tile_number: int, save_fig: bool, draw_ref=False):
 
     module_dir = os.path.dirname(os.path.abspath(__file__))
     imgs_dir = os.path.join(module_dir, '../../../data/croped_data/')
-    files_s1 = sorted(glob.glob(os.path.join(imgs_dir, '*s1.tif')))
-    files_ref = sorted(glob.glob(os.path.join(imgs_dir, '*ref.tif')))
-    tile_str = os.path.splitext(os.path.basename(files_s1[tile_number]))[0]
+    _, files = tile_files(imgs_dir, tile_number,
+                          ['s1'] + ['ref'] * draw_ref, catalog)
+    tile_str = os.path.splitext(os.path.basename(files['s1']))[0]
     save_dir = os.path.join(module_dir, '../../../data/figures/')
 
-    with rasterio.open(files_s1[tile_number]) as s1_ds:
+    with rasterio.open(files['s1']) as s1_ds:
          
         s1 = normalize_image(np.transpose(s1_ds.read(), (1, 2, 0)))
         s1 = cv2.resize(s1, (400, 400))
         s1 = adjust_gamma(s1, 1.2)
 
         if draw_ref:
-            with rasterio.open(files_ref[tile_number]) as reference:
+            with rasterio.open(files['ref']) as reference:
                 ref = reference.read(1).astype(np.uint8)
                 edges = cv2.Canny(ref, threshold1=0, threshold2=1)
                 red_mask = np.stack((edges,) * 3, axis=-1)
@@ -212,16 +251,18 @@ def s1_image(tile_number: int, save_fig: bool, draw_ref=False):
         plt.title(tile_str)
 
 
-def palsar_image(tile_number: int, save_fig: bool, draw_ref=False):
+def palsar_image(tile_number, save_fig: bool, draw_ref=False,
+                 catalog=None):
     '''
     Visualizes a ALOS/PALSAR-2 Band L HV imagery tile.
     Red: HV 2016. Green: HV 2018. Blue: HV 2020.
 
 
     Parameters:
-    - tile_number (int): Index of the tile to visualize.
+    - tile_number (int or str): Index or tile ID of the tile to visualize.
     - draw_ref (bool): Flag to draw reference borders on the image.
     - save_fig (bool): Flag to save the visualization as a PNG image.
+    - catalog (str): The tile catalog used to look up the tile. Default: None.
 
     Example Usage:
     palsar_image(tile_number=0, draw_ref=True, save_fig=True)
@@ -235,18 +276,18 @@ def palsar_image(tile_number: int, save_fig: bool, draw_ref=False):
 
     module_dir = os.path.dirname(os.path.abspath(__file__))
     imgs_dir = os.path.join(module_dir, '../../../data/croped_data/')
-    files_palsar = sorted(glob.glob(os.path.join(imgs_dir, '*palsar.tif')))
-    files_ref = sorted(glob.glob(os.path.join(imgs_dir, '*ref.tif')))
-    tile_str = os.path.splitext(os.path.basename(files_palsar[tile_number]))[0]
+    _, files = tile_files(imgs_dir, tile_number,
+                          ['palsar'] + ['ref'] * draw_ref, catalog)
+    tile_str = os.path.splitext(os.path.basename(files['palsar']))[0]
     save_dir = os.path.join(module_dir, '../../../data/figures/')
 
-    with rasterio.open(files_palsar[tile_number]) as palsar_ds:
+    with rasterio.open(files['palsar']) as palsar_ds:
         palsar = normalize_image(np.transpose(palsar_ds.read(), (1, 2, 0)))
         palsar = cv2.resize(palsar, (400, 400))
         palsar = adjust_gamma(palsar, 0.8)
 
         if draw_ref:
-            with rasterio.open(files_ref[tile_number]) as reference:
+            with rasterio.open(files['ref']) as reference:
                 ref = reference.read(1).astype(np.uint8)
                 edges = cv2.Canny(ref, threshold1=0, threshold2=1)
                 red_mask = np.stack((edges,) * 3, axis=-1)
@@ -263,7 +304,8 @@ def palsar_image(tile_number: int, save_fig: bool, draw_ref=False):
         plt.title(tile_str)
 
 
-def all_images(tile_number: int, save_fig: bool, draw_ref=False):
+def all_images(tile_number, save_fig: bool, draw_ref=False,
+               catalog=None):
     '''
     Visualizes all imagery tile.
     Planet RGB. RGB median composite from year 2020.
@@ -272,9 +314,10 @@ def all_images(tile_number: int, save_fig: bool, draw_ref=False):
     ALOS/PALSAR-2 L-Band. Red: HV 2016. Green: HV 2018. Blue: HV 2020.
 
     Parameters:
-    - tile_number (int): Index of the tile to visualize.
+    - tile_number (int or str): Index or tile ID of the tile to visualize.
     - draw_ref (bool): Flag to draw reference borders on the image.
     - save_fig (bool): Flag to save the visualization as a PNG image.
+    - catalog (str): The tile catalog used to look up the tile. Default: None.
 
     Example Usage:
     all_images(tile_number=0, draw_ref=True, save_fig=True)
@@ -288,17 +331,14 @@ def all_images(tile_number: int, save_fig: bool, draw_ref=False):
 
     module_dir = os.path.dirname(os.path.abspath(__file__))
     imgs_dir = os.path.join(module_dir, '../../../data/croped_data/')
-    files_planet = sorted(glob.glob(os.path.join(imgs_dir, '*planet.tif')))
-    files_ndvi = sorted(glob.glob(os.path.join(imgs_dir, '*ndvi.tif')))
-    files_s1 = sorted(glob.glob(os.path.join(imgs_dir, '*s1.tif')))
-    files_palsar = sorted(glob.glob(os.path.join(imgs_dir, '*palsar.tif')))
-    files_ref = sorted(glob.glob(os.path.join(imgs_dir, '*ref.tif')))
+    sensors = ['planet', 'ndvi', 's1', 'palsar'] + ['ref'] * draw_ref
+    tile, files = tile_files(imgs_dir, tile_number, sensors, catalog)
     save_dir = os.path.join(module_dir, '../../../data/figures/')
 
-    with rasterio.open(files_planet[tile_number]) as planet_ds,\
-         rasterio.open(files_ndvi[tile_number]) as ndvi_ds,\
-         rasterio.open(files_s1[tile_number]) as s1_ds,\
-         rasterio.open(files_palsar[tile_number]) as palsar_ds:
+    with rasterio.open(files['planet']) as planet_ds,\
+         rasterio.open(files['ndvi']) as ndvi_ds,\
+         rasterio.open(files['s1']) as s1_ds,\
+         rasterio.open(files['palsar']) as palsar_ds:
 
         planet = np.transpose(planet_ds.read()[0:3], (1, 2, 0))
         planet = normalize_image(planet)
@@ -317,7 +357,7 @@ def all_images(tile_number: int, save_fig: bool, draw_ref=False):
         palsar = adjust_gamma(palsar, 0.8)
 
         if draw_ref:
-            with rasterio.open(files_ref[tile_number]) as reference:
+            with rasterio.open(files['ref']) as reference:
                 ref = reference.read(1).astype(np.uint8)
                 edges = cv2.Canny(ref, threshold1=0, threshold2=1)
                 red_mask = np.stack((edges,) * 3, axis=-1)
@@ -328,7 +368,7 @@ def all_images(tile_number: int, save_fig: bool, draw_ref=False):
 
         fig, axs = plt.subplots(2, 2, figsize=(6, 6))
 
-        fig.suptitle('Tile ' + str(tile_number), size=12)
+        fig.suptitle(tile, size=12)
 
         axs[0, 0].imshow(planet)
         axs[0, 0].set_title('Planet RGB 2020 (5m)', size=9,  pad=10)
@@ -353,6 +393,6 @@ def all_images(tile_number: int, save_fig: bool, draw_ref=False):
         plt.tight_layout()
 
         if save_fig:
-            save_string = f"tile_{str(tile_number)}_all.png"
+            save_string = f"{tile}_all.png"
             save_path = os.path.join(save_dir, save_string)
             plt.savefig(save_path, facecolor='white')
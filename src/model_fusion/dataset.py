@@ -1,10 +1,21 @@
 from torch.utils.data import Dataset
+import collections
 import numpy as np
+import torch
 import rasterio
-import glob
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import random
+from src.data.tools.catalog import open_catalog, pair_files, tile_ids
+from src.data.tools.compact_storage import (check_storage, compact,
+                                            compact_mask, expand, expand_mask)
+from src.data.tools.packed_store import PackedStore, pack_arrays
+from src.data.tools.shard_dataset import (SHARD_SIZE, ShardedDataset,
+                                          write_shards)
+from src.data.tools.shared_tensors import SharedStack
+
+random.seed(42)
+np.random.seed(42)
 
 
 def normalize_image(image, sensor:str):
@@ -20,102 +31,328 @@ def normalize_image(image, sensor:str):
     return image
 
 
-def gen_images(sensor: str, image_dir: str, mask_dir=None, transform=None,):
-    random.seed(42)
-    images = []
-    masks = []
-    img_files = sorted(glob.glob(image_dir + '/*' + sensor + '.tif'))
+# Range of the values returned by normalize_image, used to quantize the chips
+# stored as uint8
+VALUE_RANGE = {'ndvi': (0, 1), 's1': (0, 1), 'palsar': (0, 1)}
+
+
+def read_image(path: str, sensor: str):
+    with rasterio.open(path) as ds:
+        image = np.transpose(ds.read(), (1, 2, 0))
+    return normalize_image(image, sensor)
+
+
+def read_mask(path: str):
+    with rasterio.open(path) as ds:
+        return ds.read(1).astype(np.float32)
+
+
+def to_tensors(image, mask=None):
+    transform = A.Compose([
+        A.Resize(height=image.shape[0], width=image.shape[1]),
+        ToTensorV2(),
+    ],)
+
+    if mask is None:
+        return transform(image=image)['image']
+    transformed = transform(image=image, mask=mask)
+    return transformed['image'], transformed['mask']
+
+
+def random_augmentation():
+    """
+    Draw one rotation and flips to apply alike to every sensor and the mask.
+    Rotations are about the centre of each chip and the chips share their
+    extent, so NDVI, S1 (half resolution), PALSAR (quarter resolution) and
+    the mask stay co-registered.
+    """
+    angle = random.uniform(-35, 35)
+    return A.Compose([
+        A.Rotate(limit=(angle, angle), p=1.0),
+        A.HorizontalFlip(p=float(random.random() < 0.5)),
+        A.VerticalFlip(p=float(random.random() < 0.1)),
+        ToTensorV2(),
+    ],)
+
+
+def augment(ndvi, s1, palsar, mask):
+    transform = random_augmentation()
+    transformed = transform(image=ndvi, mask=mask)
+    return (transformed['image'], transform(image=s1)['image'],
+            transform(image=palsar)['image'], transformed['mask'])
+
+
+def seed_worker(worker_id):
+    # give every DataLoader worker its own augmentation stream
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def tile_files(image_dir: str, mask_dir: str, catalog=None):
+    # pair the sensors and masks by tile ID
+    with open_catalog(catalog, image_dir, mask_dir) as catalog:
+        return pair_files({'ndvi': image_dir, 's1': image_dir,
+                           'palsar': image_dir, 'ref': mask_dir}, catalog)
+
+
+def gen_images(sensor: str, image_dir: str, mask_dir=None, files=None,
+               storage='float32'):
+    if files is None:
+        sources = {sensor: image_dir}
+        if sensor == 'ndvi':
+            # pair the images and masks by tile ID
+            sources['ref'] = mask_dir
+        files = pair_files(sources)
+    img_files = files[sensor]
+    # one shared-memory block per array, indexed by every worker
+    images = SharedStack(len(img_files))
+    masks = SharedStack(len(img_files))
 
     if sensor == 'ndvi':
-        mask_files = sorted(glob.glob(mask_dir + '/*tif'))
-        for img, mask in zip(img_files, mask_files):
-            with rasterio.open(img) as ds:
-                image = np.transpose(ds.read(), (1, 2, 0))
-                norm_img = normalize_image(image, sensor)
-
-            with rasterio.open(mask) as ds:
-                mask = ds.read(1).astype(float)
-
-            format_transform = A.Compose([
-                A.Resize(height=image.shape[0], width=image.shape[1]),
-                ToTensorV2(),
-            ],)
-
-            transfomed = format_transform(image=norm_img, mask=mask)
-            img_tensor = transfomed['image']
-            mask_tensor = transfomed['mask']
-            images.append(img_tensor)
-            masks.append(mask_tensor)
-
-            train_transform = A.Compose([
-                A.Resize(height=image.shape[0], width=image.shape[1]),
-                A.Rotate(limit=35, p=1.0),
-                A.HorizontalFlip(p=0.5),
-                A.VerticalFlip(p=0.1),
-                ToTensorV2(),
-                ],)
-
-            if transform:
-                augmentations = train_transform(image=norm_img, mask=mask)
-                trans_img = augmentations['image']
-                trans_mask = augmentations['mask']
-                images.append(trans_img)
-                masks.append(trans_mask)
-
-        return [images, masks]
+        for img, mask in zip(img_files, files['ref']):
+            norm_img = read_image(img, sensor)
+            mask = read_mask(mask)
+
+            img_tensor, mask_tensor = to_tensors(norm_img, mask)
+            images.append(compact(img_tensor, storage, VALUE_RANGE[sensor]))
+            masks.append(compact_mask(mask_tensor, storage))
+
+        return [images.tensor, masks.tensor]
 
     else:
         for img in img_files:
-            with rasterio.open(img) as ds:
-                image = np.transpose(ds.read(), (1, 2, 0))
-                norm_img = normalize_image(image, sensor)
-
-            format_transform = A.Compose([
-                A.Resize(height=image.shape[0], width=image.shape[1]),
-                ToTensorV2(),
-            ],)
-
-            transfomed = format_transform(image=norm_img)
-            img_tensor = transfomed['image']
-            images.append(img_tensor)
-
-            train_transform = A.Compose([
-                A.Resize(height=image.shape[0], width=image.shape[1]),
-                A.Rotate(limit=35, p=1.0),
-                A.HorizontalFlip(p=0.5),
-                A.VerticalFlip(p=0.1),
-                ToTensorV2(),
-                ],)
-
-            if transform:
-                augmentations = train_transform(image=norm_img)
-                trans_img = augmentations['image']
-                images.append(trans_img)
-        return images
+            norm_img = read_image(img, sensor)
+            images.append(compact(to_tensors(norm_img), storage,
+                                  VALUE_RANGE[sensor]))
+        return images.tensor
+
+
+def chip_sources(image_dir: str, mask_dir: str, catalog=None,
+                 storage='float32'):
+    """
+    Return the {name: (paths, read)} of the chips of every sensor and the
+    masks, normalized, channels first and in their storage dtype, as taken
+    by pack_arrays and write_shards.
+    """
+    check_storage(storage)
+    files = tile_files(image_dir, mask_dir, catalog)
+    size = min(len(paths) for paths in files.values())
+
+    def reader(sensor):
+        def read_chw(path):
+            image = read_image(path, sensor).transpose(2, 0, 1)
+            image = compact(torch.from_numpy(image), storage,
+                            VALUE_RANGE[sensor])
+            return np.ascontiguousarray(image.numpy())
+        return read_chw
+
+    def read_compact_mask(path):
+        return compact_mask(torch.from_numpy(read_mask(path)), storage).numpy()
+
+    return {'ndvi': (files['ndvi'][:size], reader('ndvi')),
+            's1': (files['s1'][:size], reader('s1')),
+            'palsar': (files['palsar'][:size], reader('palsar')),
+            'mask': (files['ref'][:size], read_compact_mask)}
+
+
+def pack_dataset(image_dir: str, mask_dir: str, out_dir: str, catalog=None,
+                 storage='float32'):
+    """
+    Pack the normalized NDVI, Sentinel-1 and ALOS/PALSAR-2 chips, channels
+    first, and the masks into a memory-mapped store served by
+    RSDataset(packed=out_dir).
+
+    Parameters:
+    - image_dir (str): The directory of the image chips.
+    - mask_dir (str): The directory of the masks.
+    - out_dir (str): The directory of the packed store.
+    - catalog (str): The tile catalog used to pair the chips by tile ID. Default: None.
+    - storage (str): 'float32', 'float16' or 'uint8' chips, see RSDataset. Default: 'float32'.
+
+    Example Usage:
+    pack_dataset(TRAIN_IMG_DIR, TRAIN_MASK_DIR, '../../data/packed/train')
+    """ # noqa
+    sources = chip_sources(image_dir, mask_dir, catalog, storage)
+    pack_arrays(sources, out_dir, tile_ids(sources['mask'][0]))
+
+
+def shard_dataset(image_dir: str, mask_dir: str, out_dir: str, catalog=None,
+                  storage='float32', shard_size=SHARD_SIZE):
+    """
+    Write the normalized chips of every sensor and the masks into shard
+    files streamed by sharded_dataset, for training sets too large to load.
+
+    Parameters:
+    - image_dir (str): The directory of the image chips.
+    - mask_dir (str): The directory of the masks.
+    - out_dir (str): The directory of the shards.
+    - catalog (str): The tile catalog used to pair the chips by tile ID. Default: None.
+    - storage (str): 'float32', 'float16' or 'uint8' chips, see RSDataset. Default: 'float32'.
+    - shard_size (int): The number of tiles per shard. Default: 64.
+
+    Example Usage:
+    shard_dataset(TRAIN_IMG_DIR, TRAIN_MASK_DIR, '../../data/shards/train', storage='uint8')
+    """ # noqa
+    sources = chip_sources(image_dir, mask_dir, catalog, storage)
+    write_shards(sources, out_dir, shard_size, tile_ids(sources['mask'][0]))
+
+
+def prepare_sample(ndvi, s1, palsar, mask, augmented=False):
+    """
+    Expand the stored tensors of a tile to float32, augmented or not.
+    """
+    # float32 tensors are returned as is, compact ones expanded
+    ndvi = expand(ndvi, VALUE_RANGE['ndvi'])
+    s1 = expand(s1, VALUE_RANGE['s1'])
+    palsar = expand(palsar, VALUE_RANGE['palsar'])
+    mask = expand_mask(mask)
+
+    if not augmented:
+        return ndvi, s1, palsar, mask
+
+    # augment channels-last views of the tensors
+    return augment(ndvi.numpy().transpose(1, 2, 0),
+                   s1.numpy().transpose(1, 2, 0),
+                   palsar.numpy().transpose(1, 2, 0), mask.numpy())
+
+
+def prepare_shard_sample(tile, copy):
+    # the second copy of every tile is augmented, as in RSDataset
+    return prepare_sample(tile['ndvi'], tile['s1'], tile['palsar'],
+                          tile['mask'], augmented=copy == 1)
+
+
+def sharded_dataset(path: str, transform=None, **kwargs):
+    """
+    Stream the shards written by shard_dataset, yielding the samples of
+    RSDataset: every tile, followed by an augmented copy with transform.
+
+    Parameters:
+    - path (str): The directory of the shards.
+    - transform (bool): Add an augmented sample of every tile. Default: None.
+    - kwargs: shuffle, buffer_size, seed, rank and world_size of ShardedDataset.
+
+    Returns:
+    - dataset (ShardedDataset): The IterableDataset. Call set_epoch every epoch.
+
+    Example Usage:
+    train_ds = sharded_dataset('../../data/shards/train', transform=True, buffer_size=512)
+    """ # noqa
+    return ShardedDataset(path, copies=2 if transform else 1,
+                          sample_fn=prepare_shard_sample, **kwargs)
 
 
 class RSDataset(Dataset):
+    """
+    Dataset of the NDVI, Sentinel-1 and ALOS/PALSAR-2 chips and the masks.
+
+    By default every tile is read, normalized and converted to tensors up
+    front. With lazy=True the tiles are read on demand in __getitem__, so
+    the first batch starts immediately and the dataset does not need to fit
+    in memory. With transform, every tile yields its original chips followed
+    by a sample augmented in __getitem__, so every epoch sees a fresh
+    rotation and flips without storing augmented copies.
+
+    With storage='float16' or 'uint8' the chips are held at 2 or 4 bytes
+    less per value, uint8 quantized over VALUE_RANGE, and the masks as uint8.
+    Every sample is expanded back to float32 in __getitem__.
+
+    The loaded chips are held in one shared-memory tensor per array, so the
+    DataLoader workers index them without copying.
+
+    Parameters:
+    - image_dir (str): The directory of the image chips.
+    - mask_dir (str): The directory of the masks.
+    - transform (bool): Add an augmented sample of every tile. Default: None.
+    - catalog (str): The tile catalog used to pair the chips by tile ID. Default: None.
+    - lazy (bool): Read the tiles on demand. Default: False.
+    - cache_size (int): With lazy, number of normalized tiles kept in an LRU cache, per worker process. Default: 0.
+    - packed (str): Serve the samples from the store written by pack_dataset instead of the chips. Default: None.
+    - storage (str): 'float32', 'float16' or 'uint8' chips in memory and in the cache. Packed stores keep the storage they were packed with. Default: 'float32'.
+    """ # noqa
     def __init__(self,
                  image_dir,
                  mask_dir,
-                 transform=None):
+                 transform=None,
+                 catalog=None,
+                 lazy=False,
+                 cache_size=0,
+                 packed=None,
+                 storage='float32'):
+        check_storage(storage)
         self.image_dir = image_dir
         self.mask_dir = mask_dir
         self.transform = transform
-        self.images = gen_images('ndvi', image_dir, mask_dir, transform)
-        self.s1 = gen_images('s1', image_dir, None, transform)
-        self.palsar = gen_images('palsar', image_dir, None, transform)
+        self.storage = storage
+        self.lazy = lazy
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()
+        self.packed = None if packed is None else PackedStore(packed)
+        if self.packed is not None:
+            return
+
+        files = tile_files(image_dir, mask_dir, catalog)
+
+        if lazy:
+            self.files = list(zip(files['ndvi'], files['s1'],
+                                  files['palsar'], files['ref']))
+            return
+
+        self.images = gen_images('ndvi', image_dir, mask_dir, files, storage)
+        self.s1 = gen_images('s1', image_dir, None, files, storage)
+        self.palsar = gen_images('palsar', image_dir, None, files, storage)
+
+    def load_tile(self, tile):
+        """
+        Read and normalize the chips and mask of a tile into tensors in
+        their storage dtype, through the cache.
+        """
+        if tile in self.cache:
+            self.cache.move_to_end(tile)
+            return self.cache[tile]
+
+        ndvi, s1, palsar, mask = self.files[tile]
+        image, mask = to_tensors(read_image(ndvi, 'ndvi'), read_mask(mask))
+        tensors = (compact(image, self.storage, VALUE_RANGE['ndvi']),
+                   compact(to_tensors(read_image(s1, 's1')), self.storage,
+                           VALUE_RANGE['s1']),
+                   compact(to_tensors(read_image(palsar, 'palsar')),
+                           self.storage, VALUE_RANGE['palsar']),
+                   compact_mask(mask, self.storage))
+
+        if self.cache_size > 0:
+            self.cache[tile] = tensors
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return tensors
 
     # Define len function
     def __len__(self):
-        return len(self.images[1])
+        if self.packed is not None:
+            tiles = len(self.packed)
+        elif self.lazy:
+            tiles = len(self.files)
+        else:
+            tiles = len(self.images[1])
+        return tiles * (2 if self.transform else 1)
 
     def __getitem__(self, index):
 
-        image = self.images[0][index]
-        mask = self.images[1][index]
-        s1 = self.s1[index]
-        palsar = self.palsar[index]
+        # odd samples are augmented when transform is set
+        if self.transform:
+            tile, augmented = divmod(index, 2)
+        else:
+            tile, augmented = index, 0
 
-        return image, s1, palsar, mask
+        if self.lazy:
+            ndvi, s1, palsar, mask = self.load_tile(tile)
+        elif self.packed is not None:
+            sample = self.packed[tile]
+            ndvi, s1, palsar, mask = (sample['ndvi'], sample['s1'],
+                                      sample['palsar'], sample['mask'])
+        else:
+            ndvi, s1, palsar, mask = (self.images[0][tile], self.s1[tile],
+                                      self.palsar[tile], self.images[1][tile])
 
+        return prepare_sample(ndvi, s1, palsar, mask, augmented)
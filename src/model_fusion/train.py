@@ -6,6 +6,7 @@ from tqdm import tqdm
 from loss_fn import TverskyLoss, DiceLoss # noqa
 import torch.optim as optim
 from model import UNET
+from augment import add_augmented_copies
 from utils import (load_checkpoint, # noqa
                    save_checkpoint,
                    get_loaders,
@@ -28,6 +29,9 @@ IMAGE_HEIGHT = 400
 IMAGE_WIDTH = 400
 PIN_MEMORY = True
 LOAD_MODEL = False
+# rotate and flip whole batches on DEVICE instead of per sample in the
+# DataLoader workers
+GPU_AUGMENT = False
 TRAIN_IMG_DIR = '../../data/ai_data/train_images'
 TRAIN_MASK_DIR = '../../data/ai_data/train_masks'
 VAL_IMG_DIR = '../../data/ai_data/val_images'
@@ -58,6 +62,11 @@ def train_fn(loader, model, optimizer, loss_fn, scaler):
         s1 = s1.to(device=DEVICE)
         palsar = palsar.to(device=DEVICE)
         mask = mask.float().unsqueeze(1).to(device=DEVICE)
+        if GPU_AUGMENT:
+            # every tile followed by an augmented copy, one transform per
+            # sample for every resolution, as with the CPU transform
+            (planet, s1, palsar), mask = add_augmented_copies(
+                (planet, s1, palsar), mask)
 
         # forward
         with torch.cuda.amp.autocast():
@@ -87,14 +96,19 @@ def main():
         TRAIN_MASK_DIR,
         VAL_IMG_DIR,
         VAL_MASK_DIR,
-        BATCH_SIZE,
+        # the augmented copies double the batches on DEVICE
+        BATCH_SIZE // 2 if GPU_AUGMENT else BATCH_SIZE,
         NUM_WORKERS,
         PIN_MEMORY,
+        transform=not GPU_AUGMENT,
     )
 
     scaler = torch.cuda.amp.GradScaler()
 
     for epoch in range(NUM_EPOCHS):
+        # draw a new shard order when streaming the shards
+        if hasattr(train_loader.dataset, 'set_epoch'):
+            train_loader.dataset.set_epoch(epoch)
         loss = train_fn(train_loader, model, optimizer, loss_fn, scaler)
 
         # save model
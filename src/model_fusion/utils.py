@@ -1,6 +1,6 @@
 import torch
 import torchvision
-from dataset import RSDataset
+from dataset import RSDataset, seed_worker, sharded_dataset
 from torch.utils.data import DataLoader
 
 
@@ -21,28 +21,52 @@ def get_loaders(
         val_mask_dir,
         batch_size,
         num_workers=4,
-        pin_memory=True,):
+        pin_memory=True,
+        lazy=False,
+        cache_size=0,
+        train_packed=None,
+        val_packed=None,
+        storage='float32',
+        train_shards=None,
+        val_shards=None,
+        transform=True,):
     
     
-    train_ds = RSDataset(
-        image_dir=train_img_dir,
-        mask_dir=train_mask_dir,
-        transform=True
-    )
+    if train_shards is not None:
+        # stream the shards written by shard_dataset, which shuffles them
+        train_ds = sharded_dataset(train_shards, transform)
+    else:
+        train_ds = RSDataset(
+            image_dir=train_img_dir,
+            mask_dir=train_mask_dir,
+            transform=transform,
+            lazy=lazy,
+            cache_size=cache_size,
+            packed=train_packed,
+            storage=storage,
+        )
     
     train_loader = DataLoader(
         train_ds,
         batch_size=batch_size,
         num_workers=num_workers,
         pin_memory=pin_memory,
-        shuffle=True
+        worker_init_fn=seed_worker,
+        shuffle=train_shards is None
     )
     
-    val_ds = RSDataset(
-        image_dir=val_img_dir,
-        mask_dir=val_mask_dir,
-        transform=False,
-    )
+    if val_shards is not None:
+        val_ds = sharded_dataset(val_shards, shuffle=False)
+    else:
+        val_ds = RSDataset(
+            image_dir=val_img_dir,
+            mask_dir=val_mask_dir,
+            transform=False,
+            lazy=lazy,
+            cache_size=cache_size,
+            packed=val_packed,
+            storage=storage,
+        )
 
 
     val_loader = DataLoader(
@@ -50,6 +74,7 @@ def get_loaders(
         batch_size=batch_size,
         num_workers=num_workers,
         pin_memory=pin_memory,
+        worker_init_fn=seed_worker,
         shuffle=False
     )
 
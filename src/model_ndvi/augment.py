@@ -0,0 +1,104 @@
+'''Batched rotate and flip augmentation applied on the training device'''
+
+import math
+import torch
+import torch.nn.functional as F
+
+
+def random_affine(batch_size: int, limit=35, hflip=0.5, vflip=0.1, p=1.0,
+                  device='cpu'):
+    """
+    Draw one rotation and flips per sample, folded into the 2x3 matrices
+    used by torch.nn.functional.affine_grid.
+
+    Parameters:
+    - batch_size (int): The number of samples.
+    - limit (float): The rotation angle is drawn in [-limit, limit] degrees. Default: 35.
+    - hflip (float): The probability of a horizontal flip. Default: 0.5.
+    - vflip (float): The probability of a vertical flip. Default: 0.1.
+    - p (float): The probability that a sample is augmented at all, the others get the identity. Default: 1.0.
+    - device (str): The device of the matrices. Default: 'cpu'.
+
+    Returns:
+    - theta (torch.Tensor): The (batch_size, 2, 3) affine matrices.
+    """ # noqa
+    def draw():
+        return torch.rand(batch_size, device=device)
+
+    angle = (draw() * 2 - 1) * math.radians(limit)
+    flip_x = torch.where(draw() < hflip, -1., 1.)
+    flip_y = torch.where(draw() < vflip, -1., 1.)
+
+    skip = draw() >= p
+    angle[skip] = 0
+    flip_x[skip] = 1
+    flip_y[skip] = 1
+
+    cos, sin = torch.cos(angle), torch.sin(angle)
+    theta = torch.zeros(batch_size, 2, 3, device=device)
+    theta[:, 0, 0] = cos * flip_x
+    theta[:, 0, 1] = -sin * flip_y
+    theta[:, 1, 0] = sin * flip_x
+    theta[:, 1, 1] = cos * flip_y
+    return theta
+
+
+def warp(batch, theta, mode='bilinear'):
+    """
+    Resample a (N, C, H, W) batch with the affine matrices of random_affine.
+    Pixels rotated in from outside the chip are set to 0.
+    """
+    grid = F.affine_grid(theta.to(batch.dtype), batch.shape,
+                         align_corners=False)
+    return F.grid_sample(batch, grid, mode=mode, padding_mode='zeros',
+                         align_corners=False)
+
+
+def augment_batch(images, mask, limit=35, hflip=0.5, vflip=0.1, p=1.0):
+    """
+    Rotate and flip whole batches on their device. The matrices work in
+    coordinates normalized to the chip extent, so applying the same matrix to
+    inputs of different resolutions covering the same area, e.g. Planet/NDVI,
+    S1 at half and PALSAR at quarter resolution, keeps them co-registered.
+    The images are resampled bilinearly and the mask with nearest neighbour.
+
+    Parameters:
+    - images (list): The (N, C, H, W) batches of every input, at any resolution.
+    - mask (torch.Tensor): The (N, 1, H, W) float batch of masks.
+    - limit, hflip, vflip, p: See random_affine.
+
+    Returns:
+    - (images, mask): The augmented batches, in the same order.
+
+    Example Usage:
+    (planet, s1, palsar), mask = augment_batch((planet, s1, palsar), mask)
+    """ # noqa
+    theta = random_affine(mask.shape[0], limit, hflip, vflip, p,
+                          device=mask.device)
+    images = [warp(image, theta) for image in images]
+    return images, warp(mask, theta, mode='nearest')
+
+
+def add_augmented_copies(images, mask, limit=35, hflip=0.5, vflip=0.1):
+    """
+    Append an augmented copy of every sample to the batches, as the CPU
+    transform does by yielding every tile followed by its augmented copy. A
+    loader of N tiles with batches of half the size thus gives the same
+    epoch of 2N samples, half of them augmented, in the same number of steps.
+
+    Parameters:
+    - images (list): The (N, C, H, W) batches of every input, at any resolution.
+    - mask (torch.Tensor): The (N, 1, H, W) float batch of masks.
+    - limit, hflip, vflip: See random_affine.
+
+    Returns:
+    - (images, mask): The (2N, C, H, W) batches, the originals first.
+
+    Example Usage:
+    (planet, s1, palsar), mask = add_augmented_copies((planet, s1, palsar), mask)
+    """ # noqa
+    augmented, augmented_mask = augment_batch(images, mask, limit, hflip,
+                                              vflip)
+    images = [torch.cat((image, copy)) for image, copy in zip(images,
+                                                               augmented)]
+    return images, torch.cat((mask, augmented_mask))
@@ -1,10 +1,18 @@
 from torch.utils.data import Dataset
+import functools
 import numpy as np
+import torch
 import rasterio
-import glob
 import albumentations as A
 from albumentations.pytorch import ToTensorV2
 import random
+from src.data.tools.catalog import open_catalog, pair_files, tile_ids
+from src.data.tools.compact_storage import (check_storage, compact,
+                                            compact_mask, expand, expand_mask)
+from src.data.tools.packed_store import PackedStore, pack_arrays
+from src.data.tools.shard_dataset import (SHARD_SIZE, ShardedDataset,
+                                          write_shards)
+from src.data.tools.shared_tensors import SharedStack
 
 random.seed(42)
 np.random.seed(42)
@@ -17,20 +25,41 @@ def normalize_image(image):
     return image
 
 
-def stack_images(image_dir: str, mask_dir: str, transform=None):
-    images = []
-    masks = []
-    img_files = sorted(glob.glob(image_dir + '/*ndvi.tif'))
-    mask_files = sorted(glob.glob(mask_dir + '/*tif'))
+# Range of the values returned by normalize_image, used to quantize the chips
+# stored as uint8. Values outside it are clipped.
+VALUE_RANGE = (0, 1)
 
-    for img, mask in zip(img_files, mask_files):
 
-        with rasterio.open(img) as ds:
-            image = np.transpose(ds.read(), (1, 2, 0))
-            image = normalize_image(image)
+def chip_files(image_dir: str, mask_dir: str, catalog=None):
+    # pair the images and masks by tile ID
+    with open_catalog(catalog, image_dir, mask_dir) as catalog:
+        files = pair_files({'ndvi': image_dir, 'ref': mask_dir}, catalog)
+    return files['ndvi'], files['ref']
+
+
+def read_image(path: str):
+    with rasterio.open(path) as ds:
+        image = np.transpose(ds.read(), (1, 2, 0))
+    return normalize_image(image)
+
+
+def read_mask(path: str):
+    with rasterio.open(path) as ds:
+        return ds.read(1).astype(np.float32)
+
 
-        with rasterio.open(mask) as ds:
-            mask = ds.read(1).astype(float)
+def stack_images(image_dir: str, mask_dir: str, catalog=None,
+                 storage='float32'):
+    img_files, mask_files = chip_files(image_dir, mask_dir, catalog)
+    # one shared-memory block per array, indexed by every worker
+    size = min(len(img_files), len(mask_files))
+    images = SharedStack(size)
+    masks = SharedStack(size)
+
+    for img, mask in zip(img_files, mask_files):
+
+        image = read_image(img)
+        mask = read_mask(mask)
 
         format_transform = A.Compose([
             A.Resize(height=image.shape[0], width=image.shape[1]),
@@ -40,35 +69,170 @@ def stack_images(image_dir: str, mask_dir: str, transform=None):
         transfomed = format_transform(image=image, mask=mask)
         img_tensor = transfomed['image']
         mask_tensor = transfomed['mask']
-        images.append(img_tensor)
-        masks.append(mask_tensor)
-
-        if transform is not None:
-            augmentations = transform(image=image, mask=mask)
-            trans_img = augmentations['image']
-            trans_mask = augmentations['mask']
-            images.append(trans_img)
-            masks.append(trans_mask)
-
-    return [images, masks]
+        images.append(compact(img_tensor, storage, VALUE_RANGE))
+        masks.append(compact_mask(mask_tensor, storage))
+
+    return [images.tensor, masks.tensor]
+
+
+def seed_worker(worker_id):
+    # give every DataLoader worker its own augmentation stream
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+def chip_sources(image_dir: str, mask_dir: str, catalog=None,
+                 storage='float32'):
+    """
+    Return the {name: (paths, read)} of the images and masks, normalized,
+    channels first and in their storage dtype, as taken by pack_arrays and
+    write_shards.
+    """
+    check_storage(storage)
+    img_files, mask_files = chip_files(image_dir, mask_dir, catalog)
+    size = min(len(img_files), len(mask_files))
+
+    def read_chw(path):
+        image = torch.from_numpy(read_image(path).transpose(2, 0, 1))
+        image = compact(image, storage, VALUE_RANGE)
+        return np.ascontiguousarray(image.numpy())
+
+    def read_compact_mask(path):
+        return compact_mask(torch.from_numpy(read_mask(path)), storage).numpy()
+
+    return {'image': (img_files[:size], read_chw),
+            'mask': (mask_files[:size], read_compact_mask)}
+
+
+def pack_dataset(image_dir: str, mask_dir: str, out_dir: str, catalog=None,
+                 storage='float32'):
+    """
+    Pack the normalized images, channels first, and the masks into a
+    memory-mapped store served by PlanetDataset(packed=out_dir).
+
+    Parameters:
+    - image_dir (str): The directory of the image chips.
+    - mask_dir (str): The directory of the masks.
+    - out_dir (str): The directory of the packed store.
+    - catalog (str): The tile catalog used to pair the chips by tile ID. Default: None.
+    - storage (str): 'float32', 'float16' or 'uint8' images, see PlanetDataset. Default: 'float32'.
+
+    Example Usage:
+    pack_dataset(TRAIN_IMG_DIR, TRAIN_MASK_DIR, '../../data/packed/train')
+    """ # noqa
+    sources = chip_sources(image_dir, mask_dir, catalog, storage)
+    pack_arrays(sources, out_dir, tile_ids(sources['mask'][0]))
+
+
+def shard_dataset(image_dir: str, mask_dir: str, out_dir: str, catalog=None,
+                  storage='float32', shard_size=SHARD_SIZE):
+    """
+    Write the normalized images and the masks into shard files streamed by
+    sharded_dataset, for training sets too large to load.
+
+    Parameters:
+    - image_dir (str): The directory of the image chips.
+    - mask_dir (str): The directory of the masks.
+    - out_dir (str): The directory of the shards.
+    - catalog (str): The tile catalog used to pair the chips by tile ID. Default: None.
+    - storage (str): 'float32', 'float16' or 'uint8' images, see PlanetDataset. Default: 'float32'.
+    - shard_size (int): The number of tiles per shard. Default: 64.
+
+    Example Usage:
+    shard_dataset(TRAIN_IMG_DIR, TRAIN_MASK_DIR, '../../data/shards/train', storage='uint8')
+    """ # noqa
+    sources = chip_sources(image_dir, mask_dir, catalog, storage)
+    write_shards(sources, out_dir, shard_size, tile_ids(sources['mask'][0]))
+
+
+def prepare_sample(image, mask, transform=None):
+    """
+    Expand the stored tensors of a tile to float32, augmented with
+    transform when given.
+    """
+    image = expand(image, VALUE_RANGE)
+    mask = expand_mask(mask)
+
+    if transform is not None:
+        augmentations = transform(image=image.numpy().transpose(1, 2, 0),
+                                  mask=mask.numpy())
+        image = augmentations['image']
+        mask = augmentations['mask']
+
+    return image, mask
+
+
+def prepare_shard_sample(tile, copy, transform=None):
+    # the second copy of every tile is augmented, as in PlanetDataset
+    return prepare_sample(tile['image'], tile['mask'],
+                          transform if copy == 1 else None)
+
+
+def sharded_dataset(path: str, transform=None, **kwargs):
+    """
+    Stream the shards written by shard_dataset, yielding the samples of
+    PlanetDataset: every tile, followed by an augmented copy with transform.
+
+    Parameters:
+    - path (str): The directory of the shards.
+    - transform (albumentations.Compose): The augmentation of the copies. Default: None.
+    - kwargs: shuffle, buffer_size, seed, rank and world_size of ShardedDataset.
+
+    Returns:
+    - dataset (ShardedDataset): The IterableDataset. Call set_epoch every epoch.
+
+    Example Usage:
+    train_ds = sharded_dataset('../../data/shards/train', train_transform, buffer_size=512)
+    """ # noqa
+    sample_fn = functools.partial(prepare_shard_sample, transform=transform)
+    return ShardedDataset(path, copies=1 if transform is None else 2,
+                          sample_fn=sample_fn, **kwargs)
 
 
 class PlanetDataset(Dataset):
     def __init__(self,
                  image_dir,
                  mask_dir,
-                 transform=None):
+                 transform=None,
+                 catalog=None,
+                 packed=None,
+                 storage='float32'):
+        check_storage(storage)
         self.image_dir = image_dir
         self.mask_dir = mask_dir
         self.transform = transform
-        self.images = stack_images(image_dir, mask_dir, transform)
+        # serve the samples from the store written by pack_dataset, which
+        # keeps the storage it was packed with
+        self.packed = None if packed is None else PackedStore(packed)
+        if self.packed is None:
+            # float16 or uint8 images and uint8 masks, expanded to float32
+            # in __getitem__
+            self.images = stack_images(image_dir, mask_dir, catalog,
+                                       storage)
 
     # Define len function
     def __len__(self):
-        return len(self.images[1])
+        if self.packed is not None:
+            tiles = len(self.packed)
+        else:
+            tiles = len(self.images[1])
+        return tiles * (1 if self.transform is None else 2)
 
     def __getitem__(self, index):
-        image = self.images[0][index]
-        mask = self.images[1][index]
-
-        return image, mask
+        # odd samples are augmented on the fly, so every epoch draws a new
+        # rotation and flips instead of reusing a stored copy
+        if self.transform is not None:
+            index, augment = divmod(index, 2)
+        else:
+            augment = 0
+
+        if self.packed is not None:
+            sample = self.packed[index]
+            image, mask = sample['image'], sample['mask']
+        else:
+            image = self.images[0][index]
+            mask = self.images[1][index]
+
+        return prepare_sample(image, mask,
+                              self.transform if augment else None)
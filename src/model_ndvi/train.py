@@ -7,6 +7,7 @@ from tqdm import tqdm
 from loss_fn import TverskyLoss, DiceLoss # noqa
 import torch.optim as optim
 from model import UNET
+from augment import add_augmented_copies
 from utils import (load_checkpoint, # noqa
                    save_checkpoint,
                    get_loaders,
@@ -25,6 +26,9 @@ IMAGE_HEIGHT = 400
 IMAGE_WIDTH = 400
 PIN_MEMORY = True
 LOAD_MODEL = False
+# rotate and flip whole batches on DEVICE instead of per sample in the
+# DataLoader workers
+GPU_AUGMENT = False
 TRAIN_IMG_DIR = '../../data/ai_data/train_images'
 TRAIN_MASK_DIR = '../../data/ai_data/train_masks'
 VAL_IMG_DIR = '../../data/ai_data/val_images'
@@ -51,6 +55,10 @@ def train_fn(loader, model, optimizer, loss_fn, scaler):
     for batch_idx, (data, targets) in enumerate(loop):
         data = data.to(device=DEVICE)
         targets = targets.float().unsqueeze(1).to(device=DEVICE)
+        if GPU_AUGMENT:
+            # every tile followed by an augmented copy, as with the CPU
+            # transform
+            (data,), targets = add_augmented_copies((data,), targets)
         # forward
         with torch.cuda.amp.autocast():
             predictions = model(data)
@@ -88,8 +96,9 @@ def main():
         TRAIN_MASK_DIR,
         VAL_IMG_DIR,
         VAL_MASK_DIR,
-        BATCH_SIZE,
-        train_transform,
+        # the augmented copies double the batches on DEVICE
+        BATCH_SIZE // 2 if GPU_AUGMENT else BATCH_SIZE,
+        None if GPU_AUGMENT else train_transform,
         NUM_WORKERS,
         PIN_MEMORY,
     )
@@ -97,6 +106,9 @@ def main():
     scaler = torch.cuda.amp.GradScaler()
 
     for epoch in range(NUM_EPOCHS):
+        # draw a new shard order when streaming the shards
+        if hasattr(train_loader.dataset, 'set_epoch'):
+            train_loader.dataset.set_epoch(epoch)
         loss = train_fn(train_loader, model, optimizer, loss_fn, scaler)
 
         # save model
@@ -1,6 +1,6 @@
 import torch
 import torchvision
-from dataset import PlanetDataset
+from dataset import PlanetDataset, seed_worker, sharded_dataset
 from torch.utils.data import DataLoader
 
 
@@ -22,33 +22,51 @@ def get_loaders(
         batch_size,
         train_transform,
         num_workers=4,
-        pin_memory=True,):
-
-    train_ds = PlanetDataset(
-        image_dir=train_img_dir,
-        mask_dir=train_mask_dir,
-        transform=train_transform
-    )
+        pin_memory=True,
+        train_packed=None,
+        val_packed=None,
+        storage='float32',
+        train_shards=None,
+        val_shards=None,):
+
+    if train_shards is not None:
+        # stream the shards written by shard_dataset, which shuffles them
+        train_ds = sharded_dataset(train_shards, train_transform)
+    else:
+        train_ds = PlanetDataset(
+            image_dir=train_img_dir,
+            mask_dir=train_mask_dir,
+            transform=train_transform,
+            packed=train_packed,
+            storage=storage,
+        )
 
     train_loader = DataLoader(
         train_ds,
         batch_size=batch_size,
         num_workers=num_workers,
         pin_memory=pin_memory,
-        shuffle=True
+        worker_init_fn=seed_worker,
+        shuffle=train_shards is None
     )
 
-    val_ds = PlanetDataset(
-        image_dir=val_img_dir,
-        mask_dir=val_mask_dir,
-        transform=None,
-    )
+    if val_shards is not None:
+        val_ds = sharded_dataset(val_shards, shuffle=False)
+    else:
+        val_ds = PlanetDataset(
+            image_dir=val_img_dir,
+            mask_dir=val_mask_dir,
+            transform=None,
+            packed=val_packed,
+            storage=storage,
+        )
 
     val_loader = DataLoader(
         val_ds,
         batch_size=batch_size,
         num_workers=num_workers,
         pin_memory=pin_memory,
+        worker_init_fn=seed_worker,
         shuffle=False
     )
 
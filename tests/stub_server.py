@@ -0,0 +1,114 @@
+'''Local stub HTTP server to exercise the chip download engines in the tests'''
+
+import contextlib
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubChipHandler(BaseHTTPRequestHandler):
+    """
+    Serve a deterministic payload of server.payload_size bytes on every GET,
+    standing in for the Earth Engine download endpoint.
+
+    The server can simulate throttling: requests beyond server.capacity
+    concurrent ones get a 429, a fraction server.error_rate get a 503 and
+    every response is delayed by server.latency seconds.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            over = (server.capacity is not None
+                    and server.in_flight > server.capacity)
+        try:
+            if server.latency:
+                time.sleep(server.latency)
+            if over:
+                self._send_error(429)
+            elif random.random() < server.error_rate:
+                self._send_error(503)
+            else:
+                self._send_chip()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _send_error(self, status):
+        with self.server.lock:
+            self.server.rejected += 1
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _send_chip(self):
+        server = self.server
+        path = self.path.encode()
+        body = path * (server.payload_size // len(path) + 1)
+        body = body[:server.payload_size]
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/tiff')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server with a listen backlog large enough for thousands of
+    concurrent connections.
+    """
+    daemon_threads = True
+    request_queue_size = 4096
+
+
+@contextlib.contextmanager
+def serve_stub(payload_size=1024, capacity=None, error_rate=0., latency=0.,
+               host='127.0.0.1', port=0, handler=StubChipHandler):
+    """
+    Run the stub server in a background thread.
+
+    Parameters:
+    - payload_size (int): Size in bytes of every served chip. Default: 1024.
+    - capacity (int): Concurrent requests served before answering 429. Default: None, unlimited.
+    - error_rate (float): Fraction of requests answered with 503. Default: 0.
+    - latency (float): Seconds added to every response. Default: 0.
+    - host (str): Interface to bind. Default: '127.0.0.1'.
+    - port (int): Port to bind, 0 picks a free one. Default: 0.
+    - handler (class): The request handler. Default: StubChipHandler.
+
+    Yields:
+    - server (StubServer): The running server, with a base_url
+    attribute and requests and rejected counters.
+
+    Example Usage:
+    with serve_stub(payload_size=4096, capacity=64, latency=0.05) as server:
+        jobs = [(f'/tmp/tile_{i}.tif', lambda i=i: f'{server.base_url}/chip/{i}') for i in range(1000)]
+        download_async(jobs, print, concurrency=128)
+    """ # noqa
+    server = StubServer((host, port), handler)
+    server.payload_size = payload_size
+    server.capacity = capacity
+    server.error_rate = error_rate
+    server.latency = latency
+    server.requests = 0
+    server.rejected = 0
+    server.in_flight = 0
+    server.lock = threading.Lock()
+    server.base_url = f"http://{host}:{server.server_address[1]}"
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
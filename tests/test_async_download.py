@@ -0,0 +1,93 @@
+'''Tests of the asyncio download backend against the local stub server'''
+
+import os
+import urllib.request
+
+import pytest
+
+import src.data.tools.async_download as async_download
+from src.data.tools.rate_control import AdaptiveLimiter
+from stub_server import serve_stub
+
+PAYLOAD_SIZE = 2048
+NUM_CHIPS = 120
+
+
+class RecordingLimiter(AdaptiveLimiter):
+    """
+    AdaptiveLimiter keeping the limit after every released request.
+    """
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.initial = self.limit
+        self.limits = [self.limit]
+        RecordingLimiter.instances.append(self)
+
+    async def release(self, status=None, latency=None, nbytes=0):
+        await super().release(status, latency, nbytes)
+        self.limits.append(self.limit)
+
+
+@pytest.fixture
+def limiters(monkeypatch):
+    RecordingLimiter.instances = []
+    monkeypatch.setattr(async_download, 'AdaptiveLimiter', RecordingLimiter)
+    return RecordingLimiter.instances
+
+
+def download(server, out_dir, num_chips=NUM_CHIPS):
+    jobs = [(os.path.join(out_dir, f'tile_{i}_s1.tif'),
+             lambda i=i: f'{server.base_url}/chip/{i}')
+            for i in range(num_chips)]
+    records = []
+    stats = async_download.download_async(jobs, records.append,
+                                          concurrency=64, tries=20,
+                                          delay=0.05, backoff=1.5,
+                                          report_every=0)
+    return records, stats
+
+
+def test_all_chips_complete_under_throttling(tmp_path, limiters):
+    with serve_stub(payload_size=PAYLOAD_SIZE, capacity=4,
+                    latency=0.01) as server:
+        records, _ = download(server, str(tmp_path))
+
+    assert server.rejected > 0
+    assert len(records) == NUM_CHIPS
+    assert all(record['status'] == 'complete' for record in records)
+    for record in records:
+        path = tmp_path / record['file']
+        assert record['bytes'] == PAYLOAD_SIZE
+        assert os.path.getsize(path) == PAYLOAD_SIZE
+
+
+@pytest.mark.parametrize('options', [{'capacity': 4},
+                                     {'error_rate': 0.2}],
+                         ids=['429', '503'])
+def test_limit_shrinks_on_congestion(tmp_path, limiters, options):
+    with serve_stub(payload_size=PAYLOAD_SIZE, latency=0.01,
+                    **options) as server:
+        records, stats = download(server, str(tmp_path))
+
+    limiter, = limiters
+    assert server.rejected > 0
+    assert stats['congested'] > 0
+    assert min(limiter.limits) < limiter.initial
+    assert all(record['status'] == 'complete' for record in records)
+
+
+def test_reports_throughput(tmp_path, limiters):
+    with serve_stub(payload_size=PAYLOAD_SIZE, capacity=8) as server:
+        _, stats = download(server, str(tmp_path))
+
+    assert stats['completed'] == NUM_CHIPS
+    assert stats['requests_per_s'] > 0
+    assert stats['bytes_per_s'] > 0
+
+
+def test_stub_payload_size_for_short_paths():
+    with serve_stub(payload_size=PAYLOAD_SIZE) as server:
+        with urllib.request.urlopen(server.base_url + '/') as response:
+            assert len(response.read()) == PAYLOAD_SIZE